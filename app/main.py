@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+# *************************************************************************
+# A Rest API for Tuya Smart Bulbs
+# Allows JSON requests to be sent over a network to control bulb colour,
+#   brightness, and more, using FastAPI, uvicorn, and TinyTuya
+# See https://github.com/TimboFimbo/TuyaSmartBulbs_API for more information
+
+# *************************************************************************
+
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+
+from app.routers import bulb_controller
+from app.services.connection_service import connections
+from app.services.log_service import logs
+from app.services.scene_service import scene_manager
+from app.services.snapshot_service import snapshot_watcher
+from app.services.startup_service import startup
+from app.services.status_service import status_cache
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.start()
+    await startup.start()
+    connections.start_keepalive()
+    connections.start_prober()
+    status_cache.start_refresher()
+    snapshot_watcher.start(startup.snapshot)
+    yield
+    await snapshot_watcher.stop()
+    await status_cache.stop_refresher()
+    await scene_manager.stop_all()
+    await connections.close_all()
+    logs.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(bulb_controller.router)
@@ -1,14 +1,16 @@
 import json
 import os
 import sys
+from typing import Literal, Optional
 
 import tinytuya
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 import Colours
 
-CON_TIMEOUT = 10
+CON_TIMEOUT = 10  # the longest a bulb is waited for, the usual wait is worked out from how fast it replies
 RETRY_LIMIT = 1
+SCENE_RETRY_LIMIT = 10  # ensures bulb reponds if wait time is high
 
 # Let's get the bulb names right, as they are sometimes used
 WHITE_LAMP = "White Lamp"
@@ -20,41 +22,85 @@ SOFA_LIGHT = "Sofa Light"
 
 
 class BulbObject:
-    def __init__(self, name_in, dev_id_in, address_in, local_key_in, version_in):
+    def __init__(self, name_in, dev_id_in, address_in, local_key_in, version_in, group_in=None, port_in=None):
         self.name = name_in
+        self.dev_id = dev_id_in
+        self.group = group_in
+        self.config = {}  # the bulb's snapshot entry
+        self.removed = False  # set once the bulb is taken out of the snapshot
+        self.set_device(address_in, local_key_in, version_in, port_in)
+
+    def set_device(self, address_in, local_key_in, version_in, port_in=None):
         self.bulb = tinytuya.BulbDevice(
-            dev_id=dev_id_in,
+            dev_id=self.dev_id,
             address=address_in,
             local_key=local_key_in,
             connection_timeout=CON_TIMEOUT,
-            version=version_in
+            version=version_in,
+            port=port_in or tinytuya.TCPPORT
         )
-
-
-bulbs: BulbObject = []
-running_scenes = []
-
-# set path of snapshot file here, or place a copy into this folder
-snapshot = os.path.join(sys.path[0], 'snapshot.json')
-with open(snapshot, 'r') as infile:
-    bulb_json = json.load(infile)
-
-for bulb in bulb_json['devices']:
-    bulbs.append(BulbObject(
-        name_in=bulb['name'],
-        dev_id_in=bulb['id'],
-        address_in=bulb['ip'],
-        local_key_in=bulb['key'],
-        version_in=bulb['ver']
-    ))
-
-
-def set_bulb_retry_limit(limit):
-    for this_bulb in bulbs:
-        this_bulb.bulb.set_socketRetryLimit(limit)
-
-
-set_bulb_retry_limit(RETRY_LIMIT)
+        self.bulb.set_socketRetryLimit(RETRY_LIMIT)
+
+
+# Bulbs are looked up by name, id or group in O(1), instead of looping over every
+# bulb for every toggle in a request
+
+class BulbRegistry:
+    def __init__(self):
+        self.bulbs = []
+        self.by_name = {}
+        self.by_id = {}
+        self.by_group = {}
+
+    def add(self, this_bulb: BulbObject):
+        self.bulbs.append(this_bulb)
+        self.index(this_bulb)
+
+    def index(self, this_bulb: BulbObject):
+        self.by_name[this_bulb.name] = this_bulb
+        self.by_id[this_bulb.dev_id] = this_bulb
+        if this_bulb.group:
+            self.by_group.setdefault(this_bulb.group, []).append(this_bulb)
+
+    def remove(self, this_bulb: BulbObject):
+        self.bulbs.remove(this_bulb)
+        self.reindex()
+
+    # Rebuilds the lookups after bulbs are renamed or regrouped, keeping the order of the bulbs
+    def reindex(self):
+        self.by_name.clear()
+        self.by_id.clear()
+        self.by_group.clear()
+        for this_bulb in self.bulbs:
+            self.index(this_bulb)
+
+    def get(self, name_or_id):
+        this_bulb = self.by_name.get(name_or_id)
+        return this_bulb if this_bulb is not None else self.by_id.get(name_or_id)
+
+    def lookup(self, key):
+        # a toggle name can be a bulb name, a bulb id, or a group name
+        this_bulb = self.get(key)
+        if this_bulb is not None:
+            return [this_bulb]
+        return self.by_group.get(key, [])
+
+    def resolve(self, toggles, only_toggled=True):
+        # Turns the toggles of a request into a list of (bulb, toggle) pairs, in toggle order,
+        # so endpoints and scenes only match names once. Unknown names are skipped
+        dispatch_list = []
+        for this_toggle in toggles:
+            if isinstance(this_toggle, BaseModel):
+                this_toggle = this_toggle.model_dump()
+            if only_toggled and not this_toggle.get('toggle', True):
+                continue
+            for this_bulb in self.lookup(this_toggle['name']):
+                dispatch_list.append((this_bulb, this_toggle))
+        return dispatch_list
+
+
+registry = BulbRegistry()
+bulbs: BulbObject = registry.bulbs
 
 
 # Compile all the bulbs into a list with a true or false toggle
@@ -81,80 +127,89 @@ class RgbColour(BaseModel):
 
 class LightningToggle(BaseModel):
     name: str = ""
+    delay: float = 0.0  # seconds this bulb flashes after the others, to make a strike roll across the room
     # red: int = 255
     # green: int = 255
     # blue: int = 255
     # colour: RgbColour = Colours.WHITE
 
 
+# The default toggles are filled in once the bulbs are loaded. They are changed in place,
+# as the request classes below use these same lists as their defaults
+
 bulb_toggles: BulbToggle = []
 multi_rgb_toggles: MultiRgbToggle = []
 lightning_toggles: LightningToggle = []
 all_colours: RgbColour = []
 multi_scene_toggles = [[], []]
 
-# set up defaults
 
-for this_bulb in bulbs:
-    multi_rgb_toggles.append(MultiRgbToggle(
-        name=this_bulb.name,
-        red=0,
-        green=0,
-        blue=0
-    ))
-    if this_bulb.name == "Black Lamp":
-        multi_scene_toggles[0].append(BulbToggle(
-            name=this_bulb.name,
-            bright_mul=0.5,
-            toggle=True
-        ))
-        bulb_toggles.append(BulbToggle(
-            name=this_bulb.name,
-            bright_mul=0.5,
-            toggle=True
-        ))
-    elif "Light" in this_bulb.name:
-        multi_scene_toggles[0].append(BulbToggle(
-            name=this_bulb.name,
-            bright_mul=2.0,
-            toggle=True
-        ))
-        bulb_toggles.append(BulbToggle(
-            name=this_bulb.name,
-            bright_mul=2.0,
-            toggle=True
-        ))
-    else:
-        multi_scene_toggles[1].append(BulbToggle(
-            name=this_bulb.name,
-            bright_mul=1.0,
-            toggle=True
-        ))
-        bulb_toggles.append(BulbToggle(
+def set_up_defaults():
+    for toggle_list in (bulb_toggles, multi_rgb_toggles, lightning_toggles,
+                        multi_scene_toggles[0], multi_scene_toggles[1]):
+        toggle_list.clear()
+
+    for this_bulb in bulbs:
+        multi_rgb_toggles.append(MultiRgbToggle(
             name=this_bulb.name,
-            bright_mul=1.0,
-            toggle=True
+            red=0,
+            green=0,
+            blue=0
         ))
+        if this_bulb.name == "Black Lamp":
+            multi_scene_toggles[0].append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=0.5,
+                toggle=True
+            ))
+            bulb_toggles.append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=0.5,
+                toggle=True
+            ))
+        elif "Light" in this_bulb.name:
+            multi_scene_toggles[0].append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=2.0,
+                toggle=True
+            ))
+            bulb_toggles.append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=2.0,
+                toggle=True
+            ))
+        else:
+            multi_scene_toggles[1].append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=1.0,
+                toggle=True
+            ))
+            bulb_toggles.append(BulbToggle(
+                name=this_bulb.name,
+                bright_mul=1.0,
+                toggle=True
+            ))
+
+    # set up lightning toggles
 
-# set up lightning toggles
+    for this_bulb in bulbs:
+        if this_bulb.name == DEN_LIGHT:
+            lightning_toggles.append(LightningToggle(
+                name=this_bulb.name,
+            ))
+        elif this_bulb.name == WHITE_LAMP:
+            lightning_toggles.append(LightningToggle(
+                name=this_bulb.name,
+            ))
+        elif this_bulb.name == WOOD_LAMP:
+            lightning_toggles.append(LightningToggle(
+                name=this_bulb.name,
+            ))
+        elif this_bulb.name == BLACK_LAMP:
+            lightning_toggles.append(LightningToggle(
+                name=this_bulb.name,
+            ))
 
-for this_bulb in bulbs:
-    if this_bulb.name == DEN_LIGHT:
-        lightning_toggles.append(LightningToggle(
-            name=this_bulb.name,
-        ))
-    elif this_bulb.name == WHITE_LAMP:
-        lightning_toggles.append(LightningToggle(
-            name=this_bulb.name,
-        ))
-    elif this_bulb.name == WOOD_LAMP:
-        lightning_toggles.append(LightningToggle(
-            name=this_bulb.name,
-        ))
-    elif this_bulb.name == BLACK_LAMP:
-        lightning_toggles.append(LightningToggle(
-            name=this_bulb.name,
-        ))
 
 for col in Colours.ALL_COLOURS:
     all_colours.append(RgbColour(
@@ -164,11 +219,74 @@ for col in Colours.ALL_COLOURS:
     ))
 
 
-# TODO add 'no_wait'
+# The bulbs are loaded from the snapshot when the app starts (see app/services/startup_service.py),
+# not when this module is imported.
+# Set the path of the snapshot file here, or place a copy into this folder
+# (TUYA_SNAPSHOT points somewhere else, e.g. at the one written by tools/bulb_simulator.py)
+
+def snapshot_path():
+    return os.environ.get('TUYA_SNAPSHOT', os.path.join(sys.path[0], 'snapshot.json'))
+
+
+def read_snapshot(path=None):
+    with open(path or snapshot_path(), 'r') as infile:
+        return json.load(infile)['devices']
+
+
+# The snapshot fields the API uses, out of everything tinytuya writes for each device
+BULB_FIELDS = ('name', 'id', 'ip', 'key', 'ver', 'group', 'port')
+CONNECTION_FIELDS = ('name', 'ip', 'key', 'ver', 'port')
+
+
+def bulb_config(bulb):
+    return {field: bulb.get(field) for field in BULB_FIELDS}
+
+
+def new_bulb(bulb):
+    this_bulb = BulbObject(
+        name_in=bulb['name'],
+        dev_id_in=bulb['id'],
+        address_in=bulb['ip'],
+        local_key_in=bulb['key'],
+        version_in=bulb['ver'],
+        group_in=bulb.get('group'),
+        port_in=bulb.get('port')
+    )
+    this_bulb.config = bulb_config(bulb)
+    return this_bulb
+
+
+# Changes a bulb to match its new snapshot entry. The BulbObject stays the same, so running
+# scenes carry on with it. Returns True if it needs a new connection (the registry has to be
+# reindexed by the caller)
+
+def update_bulb(this_bulb: BulbObject, bulb):
+    config = bulb_config(bulb)
+    reconnect = any(this_bulb.config[field] != config[field] for field in CONNECTION_FIELDS)
+    this_bulb.name = config['name']
+    this_bulb.group = config['group']
+    if reconnect:
+        this_bulb.set_device(config['ip'], config['key'], config['ver'], config['port'])
+    this_bulb.config = config
+    return reconnect
+
+
+def load_bulbs(path=None):
+    for bulb in read_snapshot(path):
+        registry.add(new_bulb(bulb))
+    set_up_defaults()
+    return bulbs
+
+
+# no_wait queues the commands and returns straight away with a command id,
+# instead of waiting for every bulb to answer. deadline (in seconds) waits at most
+# that long, and returns how each bulb got on
 class PowerClass(BaseModel):
     global bulb_toggles
     power: bool = True
     toggles: list = bulb_toggles
+    no_wait: bool = False
+    deadline: Optional[float] = Field(None, gt=0)
 
 
 class RgbClass(BaseModel):
@@ -177,29 +295,52 @@ class RgbClass(BaseModel):
     green: int
     blue: int
     toggles: list = bulb_toggles
+    no_wait: bool = False
+    deadline: Optional[float] = Field(None, gt=0)
 
 
 class MultiRgbClass(BaseModel):
     global multi_rgb_toggles
     toggles: list = multi_rgb_toggles
+    no_wait: bool = False
+    deadline: Optional[float] = Field(None, gt=0)
 
 
 class BrightnessClass(BaseModel):
     global bulb_toggles
     brightness: int
     toggles: list = bulb_toggles
+    no_wait: bool = False
+    deadline: Optional[float] = Field(None, gt=0)
+
+
+# The state to put a bulb (or a group of bulbs) in. Anything left out is not changed
+class BulbState(BaseModel):
+    name: str
+    power: Optional[bool] = None
+    mode: Optional[Literal["white", "colour", "scene", "music"]] = None
+    colour: Optional[RgbColour] = None
+    brightness: Optional[int] = None
+    bright_mul: float = 1.0
+    toggle: bool = True
+
+
+class ApplyStateClass(BaseModel):
+    states: list[BulbState]
+    no_wait: bool = False
+    deadline: Optional[float] = Field(None, gt=0)
 
 
 class RandomColourSceneClass(BaseModel):
     global bulb_toggles
     wait_time: int = 600
     toggles: list = bulb_toggles
-    colour_list: list = all_colours
+    colour_list: list[RgbColour] = all_colours
 
 
 class LightningSceneClass(BaseModel):
     global lightning_toggles
-    lightning_colour: RgbColour = Colours.WHITE
+    lightning_colour: RgbColour = RgbColour(**Colours.WHITE)
     lightning_percent_chance: int = 20
     lightning_length: float = 0.4
     default_brightness: int = 10
@@ -220,8 +361,8 @@ class MultiColourSceneClass(BaseModel):
     global multi_scene_toggles
     wait_time: int = 600
     bulb_lists: list = multi_scene_toggles
-    colour_list: list = [Colours.ORANGE,
-                         Colours.ROSE,
-                         Colours.AZURE,
-                         Colours.CHARTRUESE,
-                         Colours.VIOLET]
+    colour_list: list[RgbColour] = [RgbColour(**Colours.ORANGE),
+                                    RgbColour(**Colours.ROSE),
+                                    RgbColour(**Colours.AZURE),
+                                    RgbColour(**Colours.CHARTRUESE),
+                                    RgbColour(**Colours.VIOLET)]
@@ -1,79 +1,279 @@
 # API endpoints
-from flask import app
+import asyncio
+import json
+from functools import partial
 
+from fastapi import APIRouter, HTTPException, Query, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import PlainTextResponse
 
-# TODO add 'no_wait'
-@app.put("/set_power")
-def set_bulb_power(power_in: PowerClass):
-    stop_scenes()
-    for this_bulb in bulbs:
-        for this_toggle in power_in.toggles:
-            if this_toggle['name'] == this_bulb.name and this_toggle['toggle'] == True:
-                if power_in.power == True:
-                    this_bulb.bulb.turn_on()
-                else:
-                    this_bulb.bulb.turn_off()
+from app.models.bulb import (PowerClass, RgbClass, MultiRgbClass, BrightnessClass, ApplyStateClass,
+                             RandomColourSceneClass, LightningSceneClass, XmasSceneClass, MultiColourSceneClass,
+                             bulbs, registry, WHITE_LAMP, WOOD_LAMP, BLACK_LAMP, DEN_LIGHT, CHAIR_LIGHT, SOFA_LIGHT)
+from app.services.bulb_service import (set_colour_async, stop_scenes, release_bulbs, find_duplicate_bulb,
+                                       xmas_scene, multi_colour_scene, multi_colour_scene_async, random_colour_scene,
+                                       random_colour_scene_async, lightning_scene_async)
+from app.services.colour_service import get_final_colours
+from app.services.command_service import command_tracker
+from app.services.connection_service import connections
+from app.services.health_service import health
+from app.services.metrics_service import metrics
+from app.services.scene_service import scene_manager
+from app.services.startup_service import startup
+from app.services.status_service import status_cache
+from app.services.stream_service import FrameStream
+
+router = APIRouter()
+
+
+# Sends the commands in the background and returns the command id at once (202 Accepted),
+# for requests with 'no_wait' set. Check on them with /commands/{command_id}
+
+def queue_commands(response: Response, jobs):
+    response.status_code = status.HTTP_202_ACCEPTED
+    return command_tracker.submit(jobs, before=partial(release_bulbs, job_bulbs(jobs)))
+
+
+# Sends the commands to every bulb at once, for requests with a 'deadline', and returns how
+# each bulb got on once they have all answered or the deadline has passed, whichever is first
+
+async def send_within_deadline(jobs, deadline):
+    return await command_tracker.send_within(jobs, deadline, before=partial(release_bulbs, job_bulbs(jobs)))
+
+
+def job_bulbs(jobs):
+    return [this_bulb for this_bulb, *command in jobs]
+
+
+# The bulbs a scene's toggles point at, which the scene takes from any other scene using them
+
+def scene_bulbs(*toggle_lists):
+    return [this_bulb for toggles in toggle_lists
+            for this_bulb, this_toggle in registry.resolve(toggles, only_toggled=False)]
+
+
+# Starts the scene and returns the started message, unless none of its toggles matched a bulb
+
+async def start_scene(name, scene, this_bulbs, started):
+    if await scene_manager.start(name, scene, this_bulbs) is None:
+        return "No bulbs found for the scene"
+    return started
+
+
+@router.put("/set_power")
+async def set_bulb_power(power_in: PowerClass, response: Response):
+    command = "turn_on" if power_in.power == True else "turn_off"
+    jobs = [(this_bulb, command) for this_bulb, this_toggle in registry.resolve(power_in.toggles)]
+    if power_in.no_wait:
+        return queue_commands(response, jobs)
+    if power_in.deadline is not None:
+        return await send_within_deadline(jobs, power_in.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, command in jobs:
+        await connections.send(this_bulb, command)
 
     return "Power On" if power_in.power == True else "Power Off"
 
 
-@app.put("/set_colour")
-def set_bulb_colour(rgb: RgbClass):
-    stop_scenes()
-    for this_bulb in bulbs:
-        for this_toggle in rgb.toggles:
-            if this_toggle['name'] == this_bulb.name and this_toggle['toggle'] == True:
-                final_cols = get_final_colours(rgb.red, rgb.green, rgb.blue, this_toggle['bright_mul'])
-                this_bulb.bulb.set_colour(final_cols[0], final_cols[1], final_cols[2])
-                print("{} set to ({}, {}, {})".format(this_toggle['name'],
-                                                      final_cols[0], final_cols[1], final_cols[2]))
+@router.put("/set_colour")
+async def set_bulb_colour(rgb: RgbClass, response: Response):
+    jobs = []
+    for this_bulb, this_toggle in registry.resolve(rgb.toggles):
+        final_cols = get_final_colours(rgb.red, rgb.green, rgb.blue, this_toggle['bright_mul'])
+        jobs.append((this_bulb, "set_colour", final_cols[0], final_cols[1], final_cols[2]))
+    if rgb.no_wait:
+        return queue_commands(response, jobs)
+    if rgb.deadline is not None:
+        return await send_within_deadline(jobs, rgb.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, command, red, green, blue in jobs:
+        await connections.send(this_bulb, command, red, green, blue)
 
     return "Colour changed to ({}, {}, {})".format(rgb.red, rgb.green, rgb.blue)
 
 
-@app.put("/set_colour_async")
-async def set_bulb_colour_async(rgb: RgbClass):
+@router.put("/set_colour_async")
+async def set_bulb_colour_async(rgb: RgbClass, response: Response):
     bulb_tasks = []
-    stop_scenes()
-    for this_bulb in bulbs:
-        for this_toggle in rgb.toggles:
-            if this_toggle['name'] == this_bulb.name and this_toggle['toggle'] == True:
-                final_cols = get_final_colours(rgb.red, rgb.green, rgb.blue, this_toggle['bright_mul'])
-                bulb_tasks.append(
-                    asyncio.to_thread(set_colour_async, this_bulb, final_cols[0], final_cols[1], final_cols[2]))
-
-                print("{} set to ({}, {}, {})".format(this_toggle['name'],
-                                                      final_cols[0], final_cols[1], final_cols[2]))
+    jobs = []
+    for this_bulb, this_toggle in registry.resolve(rgb.toggles):
+        final_cols = get_final_colours(rgb.red, rgb.green, rgb.blue, this_toggle['bright_mul'])
+        jobs.append((this_bulb, "set_colour", final_cols[0], final_cols[1], final_cols[2]))
+    if rgb.no_wait:
+        return queue_commands(response, jobs)
+    if rgb.deadline is not None:
+        return await send_within_deadline(jobs, rgb.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, command, red, green, blue in jobs:
+        bulb_tasks.append(set_colour_async(this_bulb, red, green, blue))
 
     await asyncio.gather(*bulb_tasks)
     # bulb_tasks.clear()
     return "Colour changed to ({}, {}, {})".format(rgb.red, rgb.green, rgb.blue)
 
 
-@app.put("/set_multi_colour")
-def set_multi_colour(multi_rgb: MultiRgbClass):
-    stop_scenes()
-    for this_bulb in bulbs:
-        for this_toggle in multi_rgb.toggles:
-            if this_toggle['name'] == this_bulb.name and this_toggle['toggle'] == True:
-                this_bulb.bulb.set_colour(this_toggle['red'], this_toggle['green'], this_toggle['blue'])
+@router.put("/set_multi_colour")
+async def set_multi_colour(multi_rgb: MultiRgbClass, response: Response):
+    jobs = [(this_bulb, "set_colour", this_toggle['red'], this_toggle['green'], this_toggle['blue'])
+            for this_bulb, this_toggle in registry.resolve(multi_rgb.toggles)]
+    if multi_rgb.no_wait:
+        return queue_commands(response, jobs)
+    if multi_rgb.deadline is not None:
+        return await send_within_deadline(jobs, multi_rgb.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, *command in jobs:
+        await connections.send(this_bulb, *command)
 
     return "Multi colours changed"
 
 
-@app.put("/set_brightness")
-def set_bulb_brightness(brightness_in: BrightnessClass):
-    stop_scenes()
-    for this_bulb in bulbs:
-        for this_toggle in brightness_in.toggles:
-            if this_toggle['name'] == this_bulb.name and this_toggle['toggle'] == True:
-                this_bulb.bulb.set_brightness(brightness_in.brightness)
+@router.put("/set_brightness")
+async def set_bulb_brightness(brightness_in: BrightnessClass, response: Response):
+    jobs = [(this_bulb, "set_brightness", brightness_in.brightness)
+            for this_bulb, this_toggle in registry.resolve(brightness_in.toggles)]
+    if brightness_in.no_wait:
+        return queue_commands(response, jobs)
+    if brightness_in.deadline is not None:
+        return await send_within_deadline(jobs, brightness_in.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, *command in jobs:
+        await connections.send(this_bulb, *command)
 
     return "Brightness changed to {}".format(brightness_in.brightness)
 
 
+# Puts each bulb in the state given for it (power, mode, colour and brightness) with one
+# write per bulb, instead of a turn_on, set_colour and set_brightness round trip each
+
+@router.put("/apply_state")
+async def apply_bulb_state(state_in: ApplyStateClass, response: Response):
+    jobs = []
+    for this_bulb, this_state in registry.resolve(state_in.states):
+        colour = this_state['colour']
+        if colour is not None:
+            colour = get_final_colours(colour['red'], colour['green'], colour['blue'], this_state['bright_mul'])
+        jobs.append((this_bulb, "apply_state", this_state['power'], colour, this_state['brightness'],
+                     this_state['mode']))
+    if state_in.no_wait:
+        return queue_commands(response, jobs)
+    if state_in.deadline is not None:
+        return await send_within_deadline(jobs, state_in.deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    await asyncio.gather(*[connections.send(this_bulb, *command) for this_bulb, *command in jobs])
+
+    return "States applied"
+
+
+# Streams colour frames to the bulbs, e.g. {"Den Light": [255, 0, 0], "Wood Lamp": [0, 0, 255]}
+# for each frame. Each bulb gets the newest frame as fast as it can take them, and the client
+# is sent each bulb's frame counts every second
+
+@router.websocket("/stream")
+async def stream_colours(websocket: WebSocket):
+    await websocket.accept()
+    stream = FrameStream()
+    reporter = asyncio.create_task(stream.report_loop(websocket.send_json))
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                await stream.push(json.loads(message))
+            except ValueError as error:
+                await websocket.send_json({"error": str(error)})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        await stream.close()
+
+
+# Progress of a command sent with 'no_wait' (or a 'deadline'): "pending" until every bulb has
+# answered, then "done", with an "ok", "timeout", "offline" or "failed" status (with the error
+# and how long the bulb took) for each bulb
+
+@router.get("/commands/{command_id}")
+async def get_command_status(command_id: int):
+    record = command_tracker.get(command_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown command id {}".format(command_id))
+    return record
+
+
+# Bulb states, from the status cache. max_age (in seconds) overrides how old a cached
+# status can be before the bulb is asked again
+
+@router.get("/bulbs")
+async def get_bulbs(max_age: float = None):
+    return await status_cache.get_all(max_age)
+
+
+@router.get("/bulbs/{name}")
+async def get_bulb(name: str, max_age: float = None):
+    this_bulb = registry.get(name)
+    if this_bulb is None:
+        raise HTTPException(status_code=404, detail="Unknown bulb {}".format(name))
+    return await status_cache.get(this_bulb, max_age)
+
+
+# Per bulb counts of commands sent, waiting to be sent, dropped because a newer command of
+# the same kind (colour, brightness or power) replaced them before they went out, and not
+# sent at all because the bulb already had those values
+
+@router.get("/command_queues")
+async def get_command_queues():
+    return connections.queue_stats()
+
+
+# How startup went: 200 once the bulbs are loaded and warmed up, 503 before that or if the
+# snapshot could not be loaded. Bulbs that did not answer during the warm-up are listed as cold
+
+@router.get("/ready")
+async def get_ready(response: Response):
+    if not startup.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return startup.report()
+
+
+# Which bulbs are online, and for the ones that are not, when they last answered, why they
+# were taken offline and when they will next be probed
+
+@router.get("/health")
+async def get_health():
+    return health.report()
+
+
+# Command latencies, failures, retries, timeouts and reconnects for each bulb, and tick
+# durations and overruns for each scene, for Prometheus (or anything that reads its format)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(connections), media_type="text/plain; version=0.0.4")
+
+
 # Scene endpoints
 
+# Stops the running scenes, leaving the bulbs as they are
+
+@router.post("/stop_scenes")
+async def stop_running_scenes():
+    await stop_scenes()
+
+    return "Scenes stopped"
+
+
+# Lists the running scenes and the bulbs each one still owns
+
+@router.get("/scenes")
+async def running_scenes():
+    return scene_manager.describe()
+
+
 # This one is a little more complex - You pass in multiple lists of bulbs (no repeats bulbs
 # between lists), along with a list of colours. The lists of bulbs will cycle though the
 # colour list at the wait time provided, with all bulbs in each list staying in sync. Having
@@ -82,89 +282,83 @@ def set_bulb_brightness(brightness_in: BrightnessClass):
 # you are missing some colours without the application crashing. Check the default in the API
 # for an example (triggers a scene that cycles though five colors).
 
-@app.post("/start_multi_colour_scene")
-def start_multi_colour_scene(multi_class: MultiColourSceneClass, background_tasks: BackgroundTasks):
+@router.post("/start_multi_colour_scene")
+async def start_multi_colour_scene(multi_class: MultiColourSceneClass):
     # Check that no lights appear in multiple lists
-    duplicate_bulb = ""
-    for i in range(len(multi_class.bulb_lists)):
-        for j in range(len(multi_class.bulb_lists)):
-            for bulb in multi_class.bulb_lists[i]:
-                if bulb in multi_class.bulb_lists[j] and i != j:
-                    duplicate_bulb = bulb
+    duplicate_bulb = find_duplicate_bulb(multi_class.bulb_lists)
 
     if duplicate_bulb == "":
-        stop_scenes()
-        background_tasks.add_task(multi_colour_scene, multi_class)
+        return await start_scene("multi_colour_scene", multi_colour_scene(multi_class),
+                                 scene_bulbs(*multi_class.bulb_lists), "Multi Colour Scene started")
 
-    return "Multi Colour Scene started" if duplicate_bulb == "" else "{} appears on multiple lists".format(
-        duplicate_bulb)
+    return "{} appears on multiple lists".format(duplicate_bulb)
 
 
-@app.post("/start_multi_colour_scene_async")
-def start_multi_colour_scene_async(multi_class: MultiColourSceneClass, background_tasks: BackgroundTasks):
+@router.post("/start_multi_colour_scene_async")
+async def start_multi_colour_scene_async(multi_class: MultiColourSceneClass):
     # Check that no lights appear in multiple lists
-    duplicate_bulb = ""
-    for i in range(len(multi_class.bulb_lists)):
-        for j in range(len(multi_class.bulb_lists)):
-            for bulb in multi_class.bulb_lists[i]:
-                if bulb in multi_class.bulb_lists[j] and i != j:
-                    duplicate_bulb = bulb
+    duplicate_bulb = find_duplicate_bulb(multi_class.bulb_lists)
 
     if duplicate_bulb == "":
-        stop_scenes()
-        background_tasks.add_task(multi_colour_scene_async, multi_class)
+        return await start_scene("multi_colour_scene_async", multi_colour_scene_async(multi_class),
+                                 scene_bulbs(*multi_class.bulb_lists), "Multi Colour Scene started")
 
-    return "Multi Colour Scene started" if duplicate_bulb == "" else "{} appears on multiple lists".format(
-        duplicate_bulb)
+    return "{} appears on multiple lists".format(duplicate_bulb)
 
 
 # This one picks a random colour for each selected bulb at the selected wait time
 
-@app.post("/start_random_colour_scene")
-def start_random_colour_scene(random_class: RandomColourSceneClass, background_tasks: BackgroundTasks):
-    stop_scenes()
-    background_tasks.add_task(random_colour_scene, random_class)
-
-    return "Random Colour Scene started"
+@router.post("/start_random_colour_scene")
+async def start_random_colour_scene(random_class: RandomColourSceneClass):
+    return await start_scene("random_colour_scene", random_colour_scene(random_class),
+                             scene_bulbs(random_class.toggles), "Random Colour Scene started")
 
 
-@app.post("/start_random_colour_scene_async")
-def start_random_colour_scene_async(random_class: RandomColourSceneClass, background_tasks: BackgroundTasks):
-    stop_scenes()
-    background_tasks.add_task(random_colour_scene_async, random_class)
-
-    return "Random Colour Scene started"
+@router.post("/start_random_colour_scene_async")
+async def start_random_colour_scene_async(random_class: RandomColourSceneClass):
+    return await start_scene("random_colour_scene_async", random_colour_scene_async(random_class),
+                             scene_bulbs(random_class.toggles), "Random Colour Scene started")
 
 
 # pass in a list of bulbs to get a lighning scene that randomly sends strikes in bulb order
 
-@app.post("/start_lightning_scene")
-def start_lightning_scene(lightning_class: LightningSceneClass, background_tasks: BackgroundTasks):
-    stop_scenes()
-    background_tasks.add_task(lightning_scene_async, lightning_class)
-
-    return "Lightning Scene started"
+@router.post("/start_lightning_scene")
+async def start_lightning_scene(lightning_class: LightningSceneClass):
+    return await start_scene("lightning_scene_async", lightning_scene_async(lightning_class),
+                             scene_bulbs(lightning_class.toggles), "Lightning Scene started")
 
 
 # Scene triggers - move these to another file / change to activate existing methods
 
-@app.put("/set_xmas_colours")
-def set_xmas_colours():
-    stop_scenes()
-    for this_bulb in bulbs:
-        if this_bulb.name == 'White Lamp': this_bulb.bulb.set_colour(0, 200, 0)
-        if this_bulb.name == 'Wood Lamp': this_bulb.bulb.set_colour(0, 70, 0)
-        if this_bulb.name == 'Black Lamp': this_bulb.bulb.set_colour(0, 50, 0)
-        if this_bulb.name == 'Chair Light': this_bulb.bulb.set_colour(255, 0, 0)
-        if this_bulb.name == 'Sofa Light': this_bulb.bulb.set_colour(255, 0, 0)
-        if this_bulb.name == 'Den Light': this_bulb.bulb.set_colour(100, 0, 0)
+XMAS_COLOURS = {
+    WHITE_LAMP: (0, 200, 0),
+    WOOD_LAMP: (0, 70, 0),
+    BLACK_LAMP: (0, 50, 0),
+    CHAIR_LIGHT: (255, 0, 0),
+    SOFA_LIGHT: (255, 0, 0),
+    DEN_LIGHT: (100, 0, 0),
+}
+
+
+@router.put("/set_xmas_colours")
+async def set_xmas_colours(response: Response, no_wait: bool = False, deadline: float = Query(None, gt=0)):
+    jobs = []
+    for name, colour in XMAS_COLOURS.items():
+        this_bulb = registry.get(name)
+        if this_bulb is not None:
+            jobs.append((this_bulb, "set_colour", *colour))
+    if no_wait:
+        return queue_commands(response, jobs)
+    if deadline is not None:
+        return await send_within_deadline(jobs, deadline)
+
+    await release_bulbs(job_bulbs(jobs))
+    for this_bulb, *command in jobs:
+        await connections.send(this_bulb, *command)
 
     return "Xmas colours set"
 
 
-@app.post("/start_xmas_scene")
-async def start_xmas_scene(xmas_class: XmasSceneClass, background_tasks: BackgroundTasks):
-    stop_scenes()
-    background_tasks.add_task(xmas_scene, xmas_class.wait_time)
-
-    return "Xmas Scene Started"
\ No newline at end of file
+@router.post("/start_xmas_scene")
+async def start_xmas_scene(xmas_class: XmasSceneClass):
+    return await start_scene("xmas_scene", xmas_scene(xmas_class.wait_time), list(bulbs), "Xmas Scene Started")
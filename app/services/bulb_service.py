@@ -1,333 +1,195 @@
-def get_final_colours(red, green, blue, init_mul):
-    init_cols = [red, green, blue]
-    final_cols = [red, green, blue]
-
-    if init_mul > 1:
-        high_num = max(red, green, blue)
-        max_mul = round(256 / high_num, 2)
-        for i in range(len(final_cols)):
-            mul = min(init_mul, max_mul)
-            final_cols[i] = int(min(init_cols[i] * mul, 255))
-
-    elif init_mul < 1:
-        non_zeros = []
-        for val in (red, green, blue):
-            if val != 0:
-                non_zeros.append(val)
-        low_num = min(non_zeros)
-        min_mul = round(1 / low_num, 2)
-        for i in range(len(final_cols)):
-            mul = max(init_mul, min_mul)
-            final_cols[i] = int(init_cols[i] * mul)
-
-    return final_cols
-
-
-def set_colour_async(this_bulb: BulbObject, red, green, blue):
-    this_bulb.bulb.set_colour(red, green, blue)
-    print(f"{this_bulb.name} started at {strftime('%X')}")
-
-
-def lightning_flash(this_bulb: BulbObject, bulb_num, lightning_flash_brightness, lightning_length, default_brightness,
-                    flash_delay, bulb_delay):
+import asyncio
+from random import randrange
+from time import perf_counter, time
+
+from app.models.bulb import (BulbObject, RgbColour, MultiColourSceneClass, RandomColourSceneClass,
+                             LightningSceneClass, registry, SCENE_RETRY_LIMIT)
+from app.services.connection_service import connections
+from app.services.log_service import get_logger
+from app.services.metrics_service import metrics
+from app.services.scene_service import scene_manager, scene_clock
+from app.services.timeline_service import compile_multi_colour, compile_random_colour, compile_xmas, play
+
+log = get_logger("scenes")
+
+
+# Shared functions
+
+async def set_colour_async(this_bulb: BulbObject, red, green, blue):
+    start = perf_counter()
+    result = await connections.send(this_bulb, "set_colour", red, green, blue)
+    if log.enabled():
+        log.debug("bulb_set", bulb=this_bulb.name, colour=(red, green, blue),
+                  latency_ms=round((perf_counter() - start) * 1000, 1))
+    return result
+
+
+async def lightning_flash(this_bulb: BulbObject, bulb_num, lightning_flash_brightness, lightning_length,
+                          default_brightness, flash_delay, bulb_delay):
     sleep_time = flash_delay * bulb_num + bulb_delay
-    sleep(sleep_time)
+    await asyncio.sleep(sleep_time)
 
-    this_bulb.bulb.set_colour(lightning_flash_brightness, lightning_flash_brightness, lightning_flash_brightness)
-    print("{} : with delay: {} : flashed at {}".format(this_bulb.name, str(bulb_delay), int(time() * 1000)))
-    sleep(lightning_length / (bulb_num + 1))
+    await connections.send(this_bulb, "set_colour",
+                           lightning_flash_brightness, lightning_flash_brightness, lightning_flash_brightness)
+    log.debug("lightning_flash", bulb=this_bulb.name, delay=bulb_delay, at_ms=int(time() * 1000))
+    await asyncio.sleep(lightning_length / (bulb_num + 1))
 
     if bulb_num == 0:
-        this_bulb.bulb.set_colour(default_brightness, default_brightness, default_brightness)
+        await connections.send(this_bulb, "set_colour", default_brightness, default_brightness, default_brightness)
     else:
-        this_bulb.bulb.set_colour(1, 1, 1)
+        await connections.send(this_bulb, "set_colour", 1, 1, 1)
+
+
+# Flashes every bulb at once (each after its own delay, if it has one), then sets them back, and
+# returns the skew: how far apart the flashes landed, leaving out the intended delays. A flash is
+# taken to land halfway between sending it and the bulb's reply
+
+async def lightning_flash_alt(lightning_bulbs, lightning_colour: RgbColour, lightning_length, default_brightness,
+                              bulb_delays=None):
+    if not lightning_bulbs:
+        return None
+    clock = scene_clock()
+    bulb_delays = bulb_delays or [0] * len(lightning_bulbs)
+    start = perf_counter()
+
+    async def flash(this_bulb, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not clock.owns(this_bulb):
+            return None
+        sent = perf_counter()
+        await connections.send(this_bulb, "set_colour",
+                               lightning_colour.red, lightning_colour.green, lightning_colour.blue)
+        landed = (sent + perf_counter()) / 2 - start - delay
+        log.debug("lightning_flash", bulb=this_bulb.name, delay=delay, landed_ms=round(landed * 1000, 1))
+        return landed
+
+    landed = await asyncio.gather(*[flash(this_bulb, delay) for this_bulb, delay in zip(lightning_bulbs, bulb_delays)])
+    landed = [flash_landed for flash_landed in landed if flash_landed is not None]
+    if not landed:
+        return None
+    skew = max(landed) - min(landed)
+    metrics.lightning_skew.observe(skew)
+    log.info("lightning_strike", bulbs=len(landed), skew_ms=round(skew * 1000, 1))
+
+    await asyncio.sleep(lightning_length / len(lightning_bulbs))
+
+    await asyncio.gather(send_grey(clock, lightning_bulbs[0], default_brightness),
+                         *[send_grey(clock, this_bulb, 1) for this_bulb in lightning_bulbs[1:]])
+    return skew
+
+
+# Sets the bulb to a grey of the given level, unless it was taken from the scene. Scenes
+# check right before each send, as a bulb can be taken while they wait for another one
+
+async def send_grey(clock, this_bulb, level):
+    if not clock.owns(this_bulb):
+        return None
+    return await connections.send(this_bulb, "set_colour", level, level, level)
+
+
+# Returns the name of the first bulb found in more than one list, or "" if there are none
+
+def find_duplicate_bulb(bulb_lists):
+    seen_names = set()
+    for bulb_list in bulb_lists:
+        list_names = {this_bulb.name for this_bulb, this_toggle in registry.resolve(bulb_list, only_toggled=False)}
+        duplicates = list_names & seen_names
+        if duplicates:
+            return duplicates.pop()
+        seen_names |= list_names
+    return ""
 
 
-def lightning_flash_alt(lightning_bulbs, lightning_colour: RgbColour, lightning_length, default_brightness):
-    for i in range(len(lightning_bulbs)):
-        lightning_bulbs[i].bulb.set_colour(lightning_colour.red, lightning_colour.green, lightning_colour.blue)
-        print("{} : flashed at {}".format(this_bulb.name, int(time() * 1000)))
-
-    sleep(lightning_length / (i + 1))
+# Scenes
 
-    for i in range(len(lightning_bulbs)):
-        if i == 0:
-            lightning_bulbs[i].bulb.set_colour(default_brightness, default_brightness, default_brightness)
-        else:
-            lightning_bulbs[i].bulb.set_colour(1, 1, 1)
+# Cancels the running scenes and waits (up to a timeout) for them to let go of their bulbs
 
-    # for this_bulb in lightning_bulbs:
-    #     this_bulb.bulb.set_colour(lightning_flash_brightness, lightning_flash_brightness, lightning_flash_brightness)
+async def stop_scenes():
+    await scene_manager.stop_all()
 
 
-# Scenes
+# Takes the bulbs away from any scenes running on them, before sending them a command directly.
+# Scenes on other bulbs carry on
 
-def stop_scenes():
-    if len(running_scenes) > 0:
-        running_scenes.clear()
-        sleep(2)  # gives time for scene to end before next command
+async def release_bulbs(this_bulbs):
+    await scene_manager.release(this_bulbs)
 
 
 async def xmas_scene(wait_time: int):
-    scene_id = random()
-    current_time = time()
-    light_red = True
-    print("{} : Wait {} : Started at {}".format("xmas_scene", wait_time, ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(10)  # ensures bulb reponds if wait time is high
-
-    while scene_id in running_scenes:
-        for this_bulb in bulbs:
-            if light_red == True:
-                if this_bulb.name.__contains__("Light"):
-                    this_bulb.bulb.set_colour(255, 0, 0)
-                else:
-                    this_bulb.bulb.set_colour(0, 100, 0)
-            else:
-                if this_bulb.name.__contains__("Light"):
-                    this_bulb.bulb.set_colour(0, 255, 0)
-                else:
-                    this_bulb.bulb.set_colour(100, 0, 0)
-        print("Light Red = {} at {}".format(light_red, ctime(time())))
-        light_red = not light_red
-        while time() - current_time < wait_time and scene_id in running_scenes:
-            await asyncio.sleep(0.1)
-        current_time = time()
-
-    print("{} : Wait {} : Stopped at {}".format("xmas_scene", wait_time, ctime(current_time)))
-    set_bulb_retry_limit(1)
+    await play(compile_xmas(wait_time), parallel=False, retries=SCENE_RETRY_LIMIT)
 
 
 async def multi_colour_scene(multi_class: MultiColourSceneClass):
-    scene_id = random()
-    current_time = time()
-    colour_offsets = []
-    b_list_length = len(multi_class.bulb_lists)
-    c_list_length = len(multi_class.colour_list)
-    print("{} : Wait {} : Started at {}"
-          .format("multi_colour_scene", multi_class.wait_time, ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(10)
-
-    for i in range(b_list_length):
-        colour_offsets.append(i)
-
-    if c_list_length < b_list_length:
-        for x in range(b_list_length - c_list_length):
-            multi_class.colour_list.append(Colours.WHITE)
-            c_list_length = len(multi_class.colour_list)
-
-    # yeah, there are C-stye loops here. I have to sync up two lists and just find this way easier
-    # there are also a bunch of print lines for debugging, but they can be removed if desired
-    while scene_id in running_scenes:
-        for i in range(b_list_length):
-            for j in multi_class.bulb_lists[i]:
-                for this_bulb in bulbs:
-                    if this_bulb.name == j['name']:
-                        col = multi_class.colour_list[colour_offsets[i]]
-                        final_cols = get_final_colours(col['red'], col['green'], col['blue'], j['bright_mul'])
-                        this_bulb.bulb.set_colour(final_cols[0], final_cols[1], final_cols[2])
-                        print("{} set to ({}, {}, {})".format(this_bulb.name, final_cols[0], final_cols[1],
-                                                              final_cols[2]))
-
-        count = 0
-
-        for i in range(len(colour_offsets)):
-            # print ("Offset {} start: {}".format(str(i), str(colour_offsets[i])))
-            colour_offsets[i] = colour_offsets[i] + 1
-            # print ("Offset {} + 1: {}".format(str(i), str(colour_offsets[i])))
-            if colour_offsets[i] >= c_list_length:
-                colour_offsets[i] = 0
-            # print ("Offset {} final: {}".format(str(i), str(colour_offsets[i])))
-
-        # print("Offsets: {}".format(colour_offsets))
-        print()
-
-        while time() - current_time < multi_class.wait_time and scene_id in running_scenes:
-            await asyncio.sleep(0.1)
-        current_time = time()
-
-    print("{} : Wait {} : Stopped at {}"
-          .format("multi_colour_scene", multi_class.wait_time, ctime(current_time)))
-    set_bulb_retry_limit(1)
+    await play(compile_multi_colour(multi_class), parallel=False, retries=SCENE_RETRY_LIMIT)
 
 
 async def multi_colour_scene_async(multi_class: MultiColourSceneClass):
-    bulb_tasks = []
-    scene_id = random()
-    current_time = time()
-    colour_offsets = []
-    b_list_length = len(multi_class.bulb_lists)
-    c_list_length = len(multi_class.colour_list)
-    print("{} : Wait {} : Started at {}"
-          .format("multi_colour_scene", multi_class.wait_time, ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(10)
-
-    for i in range(b_list_length):
-        colour_offsets.append(i)
-
-    if c_list_length < b_list_length:
-        for x in range(b_list_length - c_list_length):
-            multi_class.colour_list.append(Colours.WHITE)
-            c_list_length = len(multi_class.colour_list)
-
-    # yeah, there are C-stye loops here. I have to sync up two lists and just find this way easier
-    # there are also a bunch of print lines for debugging, but they can be removed if desired
-    while scene_id in running_scenes:
-        for i in range(b_list_length):
-            for j in multi_class.bulb_lists[i]:
-                for this_bulb in bulbs:
-                    if this_bulb.name == j['name']:
-                        col = multi_class.colour_list[colour_offsets[i]]
-                        final_cols = get_final_colours(col['red'], col['green'], col['blue'], j['bright_mul'])
-                        bulb_tasks.append(
-                            asyncio.to_thread(set_colour_async, this_bulb, final_cols[0], final_cols[1], final_cols[2]))
-                        print("{} set to ({}, {}, {})".format(this_bulb.name, final_cols[0], final_cols[1],
-                                                              final_cols[2]))
-
-        await asyncio.gather(*bulb_tasks)
-        bulb_tasks.clear()
-        count = 0
-
-        for i in range(len(colour_offsets)):
-            # print ("Offset {} start: {}".format(str(i), str(colour_offsets[i])))
-            colour_offsets[i] = colour_offsets[i] + 1
-            # print ("Offset {} + 1: {}".format(str(i), str(colour_offsets[i])))
-            if colour_offsets[i] >= c_list_length:
-                colour_offsets[i] = 0
-            # print ("Offset {} final: {}".format(str(i), str(colour_offsets[i])))
-
-        # print("Offsets: {}".format(colour_offsets))
-        print()
-
-        while time() - current_time < multi_class.wait_time and scene_id in running_scenes:
-            await asyncio.sleep(0.1)
-        current_time = time()
-
-    print("{} : Wait {} : Stopped at {}"
-          .format("multi_colour_scene", multi_class.wait_time, ctime(current_time)))
-    set_bulb_retry_limit(1)
+    await play(compile_multi_colour(multi_class), parallel=True, retries=SCENE_RETRY_LIMIT)
 
 
 async def random_colour_scene(random_class: RandomColourSceneClass):
-    scene_id = random()
-    current_time = time()
-    print("{} : Wait {} : Started at {}"
-          .format("random_colour_scene", random_class.wait_time, ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(10)  # ensures bulb reponds if wait time is high
-
-    while scene_id in running_scenes:
-        for this_bulb in bulbs:
-            for this_toggle in random_class.toggles:
-                if this_toggle['name'] == this_bulb.name:
-                    ran_col = choice(random_class.colour_list)
-                    final_cols = get_final_colours(ran_col['red'], ran_col['green'], ran_col['blue'],
-                                                   this_toggle['bright_mul'])
-                    this_bulb.bulb.set_colour(final_cols[0], final_cols[1], final_cols[2])
-                    print("{} set to ({}, {}, {})".format(this_bulb.name, final_cols[0], final_cols[1], final_cols[2]))
-
-        print()
-        while time() - current_time < random_class.wait_time and scene_id in running_scenes:
-            await asyncio.sleep(0.1)
-        current_time = time()
-
-    print("{} : Wait {} : Stopped at {}"
-          .format("random_colour_scene", random_class.wait_time, ctime(current_time)))
-    set_bulb_retry_limit(1)
+    await play(compile_random_colour(random_class), parallel=False, retries=SCENE_RETRY_LIMIT)
 
 
 async def random_colour_scene_async(random_class: RandomColourSceneClass):
-    bulb_tasks = []
-    scene_id = random()
-    current_time = time()
-    print("{} : Wait {} : Started at {}"
-          .format("random_colour_scene", random_class.wait_time, ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(10)  # ensures bulb reponds if wait time is high
-
-    while scene_id in running_scenes:
-        for this_bulb in bulbs:
-            for this_toggle in random_class.toggles:
-                if this_toggle['name'] == this_bulb.name:
-                    ran_col = choice(random_class.colour_list)
-                    final_cols = get_final_colours(ran_col['red'], ran_col['green'], ran_col['blue'],
-                                                   this_toggle['bright_mul'])
-                    bulb_tasks.append(
-                        asyncio.to_thread(set_colour_async, this_bulb, final_cols[0], final_cols[1], final_cols[2]))
-                    print("{} set to ({}, {}, {})".format(this_bulb.name, final_cols[0], final_cols[1], final_cols[2]))
-
-        await asyncio.gather(*bulb_tasks)
-        bulb_tasks.clear()
-        print()
-
-        while time() - current_time < random_class.wait_time and scene_id in running_scenes:
-            await asyncio.sleep(0.1)
-        current_time = time()
-
-    print("{} : Wait {} : Stopped at {}"
-          .format("random_colour_scene", random_class.wait_time, ctime(current_time)))
-    set_bulb_retry_limit(1)
+    await play(compile_random_colour(random_class), parallel=True, retries=SCENE_RETRY_LIMIT)
 
 
 async def lightning_scene_async(lightning_class: LightningSceneClass):
-    bulb_tasks = []
-    scene_id = random()
-    current_time = time()
+    clock = scene_clock()
     wait_divider = 6
-    print("{} : Started at {}"
-          .format("lightning_scene", ctime(current_time)))
-    running_scenes.append(scene_id)
-    set_bulb_retry_limit(1)  # ensures bulb reponds if wait time is high
-
-    lightning_bulbs = []
-    for this_toggle in lightning_class.toggles:
-        for this_bulb in bulbs:
-            if this_toggle['name'] == this_bulb.name:
-                lightning_bulbs.append(this_bulb)
-
-    while scene_id in running_scenes:
-        rand_brightness = randrange(lightning_class.storm_brightness_range[0],
-                                    lightning_class.storm_brightness_range[1])
-
-        rand_wait = randrange((lightning_class.wait_time_range[0] * 1000),
-                              (lightning_class.wait_time_range[1] * 1000)) / 1000
-
-        rand_strike_number = randrange(0, int((100 / lightning_class.lightning_percent_chance)))
-        lightning_happening = (rand_strike_number == 0)
-
-        print("Random brightness: " + str(rand_brightness))
-        print(str(rand_strike_number))
-        print("Strike happening: " + str(lightning_happening))
-
-        if (lightning_happening):
-            await asyncio.to_thread(lightning_flash_alt, lightning_bulbs,
-                                    lightning_class.lightning_colour,
-                                    lightning_class.lightning_length,
-                                    lightning_class.default_brightness)
-
-            while time() - current_time < lightning_class.lightning_length and scene_id in running_scenes:
-                await asyncio.sleep(0.1)
-            current_time = time()
-
-        else:
-            lightning_bulbs[0].bulb.set_colour(rand_brightness, rand_brightness, rand_brightness)
-            await asyncio.sleep(rand_wait / wait_divider)
-            lightning_bulbs[0].bulb.set_colour(lightning_class.default_brightness,
-                                               lightning_class.default_brightness,
-                                               lightning_class.default_brightness)
-
-            for i in range(len(lightning_bulbs)):  # just to keep all bulbs responding - update to do this every second
-                if i != 0:
-                    lightning_bulbs[i].bulb.set_colour(1, 1, 1)
-
-            while time() - current_time < rand_wait and scene_id in running_scenes:
-                await asyncio.sleep(0.1)
-            current_time = time()
-
-            await asyncio.sleep(rand_wait)
-
-    print("{} : Stopped at {}"
-          .format("lightning_scene", ctime(current_time)))
-    # set_bulb_retry_limit(1)
\ No newline at end of file
+    log.info("scene_started", scene="lightning_scene")
+
+    lightning_toggles = registry.resolve(lightning_class.toggles, only_toggled=False)
+    lightning_bulbs = [this_bulb for this_bulb, this_toggle in lightning_toggles]
+    bulb_delays = [this_toggle.get('delay', 0) for this_bulb, this_toggle in lightning_toggles]
+    if not lightning_bulbs:
+        log.info("scene_stopped", scene="lightning_scene", reason="no bulbs")
+        return
+
+    try:
+        while True:
+            if clock.bulbs is not None and len(clock.bulbs) < len(lightning_bulbs):
+                # bulbs were taken for something else, so carry on with the rest
+                bulb_delays = [delay for this_bulb, delay in zip(lightning_bulbs, bulb_delays)
+                               if clock.owns(this_bulb)]
+                lightning_bulbs = [this_bulb for this_bulb in lightning_bulbs if clock.owns(this_bulb)]
+                if not lightning_bulbs:
+                    break
+
+            rand_brightness = randrange(lightning_class.storm_brightness_range[0],
+                                        lightning_class.storm_brightness_range[1])
+
+            rand_wait = randrange((lightning_class.wait_time_range[0] * 1000),
+                                  (lightning_class.wait_time_range[1] * 1000)) / 1000
+
+            rand_strike_number = randrange(0, int((100 / lightning_class.lightning_percent_chance)))
+            lightning_happening = (rand_strike_number == 0)
+
+            log.debug("lightning_tick", brightness=rand_brightness, strike_number=rand_strike_number,
+                      strike=lightning_happening)
+
+            if (lightning_happening):
+                await lightning_flash_alt(lightning_bulbs,
+                                          lightning_class.lightning_colour,
+                                          lightning_class.lightning_length,
+                                          lightning_class.default_brightness,
+                                          bulb_delays)
+
+                if not await clock.tick(lightning_class.lightning_length):
+                    break
+
+            else:
+                await send_grey(clock, lightning_bulbs[0], rand_brightness)
+                await asyncio.sleep(rand_wait / wait_divider)
+                await send_grey(clock, lightning_bulbs[0], lightning_class.default_brightness)
+
+                # just to keep all bulbs responding - update to do this every second
+                await asyncio.gather(*[send_grey(clock, this_bulb, 1) for this_bulb in lightning_bulbs[1:]])
+
+                # the scene has always waited twice the random wait between flickers
+                if not await clock.tick(rand_wait) or not await clock.tick(rand_wait):
+                    break
+    finally:
+        log.info("scene_stopped", scene="lightning_scene")
\ No newline at end of file
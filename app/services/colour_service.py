@@ -0,0 +1,80 @@
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, final_colours_batch falls back to the scalar path
+    np = None
+
+# Calulates final colours based on brighness multiplier
+# Will only multiply up to the point that the colours start changing
+# For example, (128, 64, 0) will top out at *2 multiplier, and
+# (10, 5, 0) will bottom out at *0.2 multiplier (this is just an
+# example - setting this low will probably result in darkness)
+#
+# Black (0, 0, 0) has no colour to keep, so it stays black for any multiplier
+
+COLOUR_CACHE_SIZE = 1024  # the scenes cycle through a small palette, see Colours.ALL_COLOURS
+MAX_CHANNEL = 255
+
+
+def get_final_colours(red, green, blue, init_mul):
+    return list(final_colours(red, green, blue, init_mul))
+
+
+@lru_cache(maxsize=COLOUR_CACHE_SIZE)
+def final_colours(red, green, blue, init_mul):
+    init_cols = (red, green, blue)
+
+    if init_mul > 1:
+        high_num = max(init_cols)
+        if high_num <= 0:
+            return init_cols
+        mul = min(init_mul, round(256 / high_num, 2))
+        return tuple(int(min(col * mul, 255)) for col in init_cols)
+
+    elif init_mul < 1:
+        non_zeros = [col for col in init_cols if col != 0]
+        if not non_zeros:
+            return init_cols
+        mul = max(init_mul, round(1 / min(non_zeros), 2))
+        return tuple(int(col * mul) for col in init_cols)
+
+    return init_cols
+
+
+# The multiplier limits for every channel value, rounded with python's round() so the
+# batch results match get_final_colours exactly. Index 0 is never used (black stays black)
+if np is not None:
+    CHANNEL_VALUES = range(1, MAX_CHANNEL + 1)
+    MAX_MULS = np.array([np.inf] + [round(256 / col, 2) for col in CHANNEL_VALUES])
+    MIN_MULS = np.array([0.0] + [round(1 / col, 2) for col in CHANNEL_VALUES])
+
+
+# Takes rows of (red, green, blue, bright_mul) and returns the final [red, green, blue]
+# for each row, the same as calling get_final_colours on each one, in one numpy pass
+
+def final_colours_batch(rows):
+    if np is None:
+        return [get_final_colours(*row) for row in rows]
+
+    rows = np.asarray(rows, dtype=float).reshape(-1, 4)
+    cols = rows[:, :3]
+    init_mul = rows[:, 3]
+    if cols.size and (cols.min() < 0 or cols.max() > MAX_CHANNEL or np.any(cols != np.floor(cols))):
+        # outside the lookup tables, so leave these to the scalar path
+        return [[int(col) for col in get_final_colours(r, g, b, m)] for r, g, b, m in rows.tolist()]
+
+    high_num = cols.max(axis=1).astype(int)
+    low_num = np.where(cols > 0, cols, np.inf).min(axis=1)
+    low_num = np.where(np.isinf(low_num), 0, low_num).astype(int)
+
+    brighter = (init_mul > 1) & (high_num > 0)
+    darker = (init_mul < 1) & (low_num > 0)
+
+    mul = np.ones(len(rows))
+    mul[brighter] = np.minimum(init_mul[brighter], MAX_MULS[high_num[brighter]])
+    mul[darker] = np.maximum(init_mul[darker], MIN_MULS[low_num[darker]])
+
+    final_cols = cols * mul[:, None]
+    final_cols[brighter] = np.minimum(final_cols[brighter], 255)
+    return final_cols.astype(int).tolist()
@@ -0,0 +1,95 @@
+import asyncio
+from collections import OrderedDict
+from itertools import count
+from time import perf_counter, time
+
+import tinytuya
+
+from app.services.connection_service import command_failed, connections
+
+# Commands sent with 'no_wait' return as soon as they are queued, and are sent in the
+# background, every bulb at once. Their progress is kept here so it can be checked with
+# the command id, until MAX_COMMANDS newer commands have pushed it out.
+#
+# Commands sent with a 'deadline' are sent the same way, but the request waits for them
+# until the deadline. It then returns each bulb's status, with bulbs that have not answered
+# yet as "timeout" (they carry on in the background, and can still be checked with the id)
+
+MAX_COMMANDS = 500
+
+# What a failed command's error code means for the bulb. error_json() gives the codes as strings
+ERROR_STATUSES = {
+    str(tinytuya.ERR_TIMEOUT): "timeout",
+    str(tinytuya.ERR_CONNECT): "offline",
+    str(tinytuya.ERR_OFFLINE): "offline",
+}
+
+
+class CommandTracker:
+    def __init__(self):
+        self.commands = OrderedDict()
+        self.command_ids = count(1)
+        self.tasks = set()
+
+    # jobs is a list of (bulb, command, *args), as passed to connections.send. The optional
+    # before coroutine function runs first, e.g. to take the bulbs from their scenes
+    def submit(self, jobs, before=None):
+        record, task = self.start(jobs, before)
+        return {"command_id": record["command_id"], "bulbs": list(record["bulbs"])}
+
+    # Sends the commands as submit does, and waits for them for up to deadline seconds
+    async def send_within(self, jobs, deadline, before=None):
+        start = perf_counter()
+        record, task = self.start(jobs, before)
+        await asyncio.wait([task], timeout=deadline)
+        waited_ms = round((perf_counter() - start) * 1000, 1)
+        results = {name: dict(bulb_record) if bulb_record["status"] != "pending"
+                   else {"status": "timeout", "latency_ms": waited_ms}
+                   for name, bulb_record in record["bulbs"].items()}
+        return {"command_id": record["command_id"], "status": record["status"], "deadline": deadline,
+                "waited_ms": waited_ms, "bulbs": results}
+
+    def start(self, jobs, before):
+        command_id = next(self.command_ids)
+        record = {
+            "command_id": command_id,
+            "status": "pending",
+            "queued_at": time(),
+            "bulbs": {this_bulb.name: {"status": "pending"} for this_bulb, *command in jobs}
+        }
+        self.commands[command_id] = record
+        while len(self.commands) > MAX_COMMANDS:
+            self.commands.popitem(last=False)
+
+        task = asyncio.create_task(self.run(record, jobs, before))
+        self.tasks.add(task)  # keep a reference, the loop only holds weak ones
+        task.add_done_callback(self.tasks.discard)
+        return record, task
+
+    async def run(self, record, jobs, before):
+        if before is not None:
+            await before()
+        await asyncio.gather(*[self.run_job(record, this_bulb, command)
+                               for this_bulb, *command in jobs])
+        record["status"] = "done"
+        record["finished_at"] = time()
+
+    async def run_job(self, record, this_bulb, command):
+        bulb_record = record["bulbs"][this_bulb.name]
+        start = perf_counter()
+        try:
+            result = await connections.send(this_bulb, *command)
+        except Exception as error:
+            bulb_record.update(status="failed", error=str(error), latency_ms=round((perf_counter() - start) * 1000, 1))
+            return
+        latency_ms = round((perf_counter() - start) * 1000, 1)
+        if command_failed(result):
+            bulb_record.update(status=ERROR_STATUSES.get(result['Err'], "failed"), error=result, latency_ms=latency_ms)
+        else:
+            bulb_record.update(status="ok", latency_ms=latency_ms)
+
+    def get(self, command_id):
+        return self.commands.get(command_id)
+
+
+command_tracker = CommandTracker()
@@ -0,0 +1,365 @@
+import asyncio
+from time import perf_counter, time
+
+import tinytuya
+from tinytuya import BulbDevice, error_json
+
+from app.services.health_service import health
+from app.services.log_service import get_logger
+from app.services.metrics_service import metrics
+from app.services.tuya_client import TuyaClient, request_limits
+
+# Each bulb keeps one socket (and one session) open, shared by the endpoints and the
+# scenes, and only reconnects when the bulb stops answering
+
+KEEPALIVE_INTERVAL = 10  # bulbs close idle sockets after ~30 seconds
+PROBE_CHECK_INTERVAL = 1  # how often to look for offline bulbs that are due a probe
+DEFAULT_VERSION = 3.3
+
+# The last values the bulb confirmed are kept as its shadow state, and writes only send the
+# data points that differ from it. The shadow is not trusted once it is older than
+# SHADOW_MAX_AGE (or after a reconnect), in case the bulb was changed from somewhere else
+SHADOW_MAX_AGE = 60
+
+# Commands that only matter for the state they leave the bulb in. If a newer command of the
+# same kind is queued before an older one is sent, the older one is dropped and its caller
+# gets the newer command's result, so a burst of slider updates only sends the last value
+COALESCED_COMMANDS = {
+    "set_colour": "colour",
+    "set_brightness": "brightness",
+    "turn_on": "power",
+    "turn_off": "power",
+    "apply_state": "state",
+}
+
+log = get_logger("commands")
+
+
+def command_failed(result):
+    # errors come back as a dict with an 'Err' code, the same as tinytuya
+    return isinstance(result, dict) and 'Err' in result
+
+
+# The result of a write that was not sent, as the bulb already had its values. Callers see an
+# empty dict, but it says nothing about whether the bulb is reachable
+class Unchanged(dict):
+    pass
+
+
+class BulbConnection:
+    def __init__(self, this_bulb):
+        self.name = this_bulb.name
+        # the tinytuya device is only used for the bulb type, its data points and the colour encoding,
+        # the commands themselves go through the asyncio client
+        self.device = this_bulb.bulb
+        self.client = TuyaClient(
+            dev_id=self.device.id,
+            address=self.device.address,
+            local_key=self.device.real_local_key.decode('latin1'),
+            version=self.device.version or DEFAULT_VERSION,
+            timeout=self.device.connection_timeout,
+            retry_limit=self.device.socketRetryLimit,
+            port=self.device.port
+        )
+        self.last_used = 0
+        self.pending = {}  # kind: (command, args, kwargs, waiters), in the order they are sent
+        self.sending = []  # waiters of the command being sent
+        self.sender = None
+        self.sent = 0
+        self.coalesced = 0
+        self.unchanged = 0  # writes that were not sent, as the bulb already had those values
+        self.stats = metrics.bulb(self.name)
+
+    async def send(self, command, *args, **kwargs):
+        kind = COALESCED_COMMANDS.get(command)
+        if kind is None:
+            return await self.run(command, *args, **kwargs)
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters = [waiter]
+        superseded = self.pending.pop(kind, None)
+        if superseded is not None:
+            self.coalesced += 1
+            waiters = superseded[3] + waiters
+        # (re)added at the end, so the newest command is sent after anything queued before it
+        self.pending[kind] = (command, args, kwargs, waiters)
+
+        if self.sender is None or self.sender.done():
+            self.sender = asyncio.create_task(self.send_pending())
+        return await waiter
+
+    async def send_pending(self):
+        while self.pending:
+            kind = next(iter(self.pending))
+            command, args, kwargs, waiters = self.pending.pop(kind)
+            self.sending = waiters
+            try:
+                result = await self.run(command, *args, **kwargs)
+            except asyncio.CancelledError:
+                for waiter in waiters:
+                    waiter.cancel()
+                raise
+            except Exception as error:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(error)
+                continue
+            finally:
+                self.sending = []
+            for waiter in waiters:
+                if not waiter.done():  # the caller may have been cancelled, e.g. a stopped scene
+                    waiter.set_result(result)
+
+    # timeout and retries only apply to this command, otherwise the client works them out
+    async def run(self, command, *args, timeout=None, retries=None, **kwargs):
+        self.stats.in_flight += 1
+        start = perf_counter()
+        token = request_limits.set((timeout, retries))
+        try:
+            result = await getattr(self, command)(*args, **kwargs)
+        finally:
+            request_limits.reset(token)
+            self.stats.in_flight -= 1
+        latency = perf_counter() - start
+        self.stats.latency.observe(latency)
+        if command_failed(result):
+            self.stats.failures += 1
+        if log.enabled():
+            log.debug("command", bulb=self.name, command=command, args=args, latency_ms=round(latency * 1000, 1),
+                      error=result.get('Error') if command_failed(result) else None)
+        self.last_used = time()
+        self.sent += 1
+        return result
+
+    def queue_stats(self):
+        return {"pending": len(self.pending), "sent": self.sent, "coalesced": self.coalesced,
+                "unchanged": self.unchanged, "rtt_ms": round(self.client.rtt * 1000, 1) if self.client.rtt else None,
+                "reply_timeout_ms": round(self.client.reply_timeout * 1000, 1)}
+
+    async def keepalive(self):
+        # skip the heartbeat if the bulb is busy, as it is already being kept awake
+        if self.client.lock.locked() or not self.client.connected:
+            return
+        if time() - self.last_used >= KEEPALIVE_INTERVAL:
+            self.last_used = time()
+            await self.client.heartbeat(nowait=True)
+
+    # The queued commands are cancelled, or given result instead (e.g. when the connection is
+    # replaced, so the scenes waiting on it carry on)
+    async def close(self, result=None):
+        queued = [self.sending] + [waiters for command, args, kwargs, waiters in self.pending.values()]
+        for waiters in queued:
+            for waiter in waiters:
+                if result is None:
+                    waiter.cancel()
+                elif not waiter.done():
+                    waiter.set_result(result)
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
+        self.pending.clear()
+        await self.client.close()
+
+    # Bulb commands, mirroring the tinytuya.BulbDevice methods of the same name
+
+    async def status(self):
+        result = await self.client.status()
+        if not self.device.bulb_configured and not command_failed(result) and 'dps' in result:
+            self.device.detect_bulb(response=result)
+        return result
+
+    async def detect_bulb(self):
+        if self.device.bulb_configured:
+            return None
+        result = await self.status()
+        if command_failed(result):
+            return result
+        if not self.device.bulb_configured:
+            return error_json(tinytuya.ERR_DEVTYPE, "Unable to detect bulb type")
+        return None
+
+    # Sends only the data points that would change the bulb, or nothing if none would
+    async def write(self, dps, nowait=False):
+        shadow = self.client.last_status
+        if self.client.connected and time() - self.client.last_status_time < SHADOW_MAX_AGE:
+            dps = {dp: value for dp, value in dps.items() if shadow.get(str(dp)) != value}
+            if not dps:
+                self.unchanged += 1
+                return Unchanged()
+        return await self.client.set_values(dps, nowait=nowait)
+
+    async def set_multiple_values(self, dps, nowait=False):
+        return await self.write(dps, nowait=nowait)
+
+    async def set_features(self, features, nowait=False):
+        error = await self.detect_bulb()
+        if error:
+            return error
+        dps = {}
+        for feature, value in features.items():
+            dp = self.device.dpset[feature]
+            if dp:
+                dps[dp] = value
+        return await self.write(dps, nowait=nowait)
+
+    async def turn_on(self, nowait=False):
+        return await self.set_features({'switch': True}, nowait=nowait)
+
+    async def turn_off(self, nowait=False):
+        return await self.set_features({'switch': False}, nowait=nowait)
+
+    async def set_colour(self, red, green, blue, nowait=False):
+        error = await self.detect_bulb()
+        if error:
+            return error
+        colour = BulbDevice.rgb_to_hexvalue(red, green, blue, self.device.dpset['value_hexformat'])
+        return await self.set_features({'colour': colour, 'mode': BulbDevice.DPS_MODE_COLOUR, 'switch': True},
+                                       nowait=nowait)
+
+    async def set_brightness(self, brightness, nowait=False):
+        error = await self.detect_bulb()
+        if error:
+            return error
+        dpset = self.device.dpset
+        if brightness < dpset['value_min']:
+            return await self.turn_off(nowait=nowait)
+        brightness = min(brightness, dpset['value_max'])
+
+        colour = self.current_colour()
+        if colour is None:
+            return await self.set_features({'mode': BulbDevice.DPS_MODE_WHITE, 'brightness': brightness,
+                                            'switch': True}, nowait=nowait)
+        return await self.set_features({'colour': self.with_brightness(colour, brightness),
+                                        'mode': BulbDevice.DPS_MODE_COLOUR, 'switch': True}, nowait=nowait)
+
+    # The bulb's colour, if it is in colour mode
+    def current_colour(self):
+        dpset = self.device.dpset
+        if self.client.last_status.get(dpset['mode']) != BulbDevice.DPS_MODE_COLOUR:
+            return None
+        return self.client.last_status.get(dpset['colour']) or None
+
+    # In colour mode the brightness is the 'value' of the colour
+    def with_brightness(self, hexvalue, brightness):
+        dpset = self.device.dpset
+        (h, s, v) = BulbDevice.hexvalue_to_hsv(hexvalue, dpset['value_hexformat'])
+        return BulbDevice.hsv_to_hexvalue(h, s, brightness / float(dpset['value_max']), dpset['value_hexformat'])
+
+    # Sets the power, mode, colour and brightness in one frame, instead of a round trip for each.
+    # Anything left as None is not changed, and setting anything turns the bulb on. A colour puts
+    # the bulb in colour mode (with the brightness as the colour's value). A brightness on its own
+    # does what set_brightness does: it keeps a bulb in colour mode in its colour, otherwise it
+    # puts the bulb in white mode
+    async def apply_state(self, power=None, colour=None, brightness=None, mode=None, nowait=False):
+        error = await self.detect_bulb()
+        if error:
+            return error
+        if power is False:
+            return await self.turn_off(nowait=nowait)
+
+        dpset = self.device.dpset
+        features = {}
+        if brightness is not None and brightness < dpset['value_min']:
+            return await self.turn_off(nowait=nowait)
+        if brightness is not None:
+            brightness = min(brightness, dpset['value_max'])
+
+        current_colour = self.current_colour() if mode in (None, BulbDevice.DPS_MODE_COLOUR) else None
+        if colour is not None:
+            hexvalue = BulbDevice.rgb_to_hexvalue(*colour, dpset['value_hexformat'])
+            if brightness is not None:
+                hexvalue = self.with_brightness(hexvalue, brightness)
+            features['colour'] = hexvalue
+            features['mode'] = BulbDevice.DPS_MODE_COLOUR
+        elif brightness is not None and current_colour is not None:
+            features['colour'] = self.with_brightness(current_colour, brightness)
+            features['mode'] = BulbDevice.DPS_MODE_COLOUR
+        elif brightness is not None:
+            features['brightness'] = brightness
+            features['mode'] = BulbDevice.DPS_MODE_WHITE
+        if mode is not None:
+            features['mode'] = mode
+        if power or features:
+            features['switch'] = True
+        return await self.set_features(features, nowait=nowait)
+
+
+class ConnectionManager:
+    def __init__(self):
+        self.connections = {}
+        self.keepalive_task = None
+        self.prober = None
+
+    def get(self, this_bulb):
+        connection = self.connections.get(this_bulb.name)
+        if connection is None or connection.device is not this_bulb.bulb:
+            connection = BulbConnection(this_bulb)
+            self.connections[this_bulb.name] = connection
+        return connection
+
+    # timeout= and retries= set the reply timeout and retry limit for this command only
+    async def send(self, this_bulb, command, *args, **kwargs):
+        if this_bulb.removed:
+            # a scene started before the bulb was taken out of the snapshot
+            return error_json(tinytuya.ERR_OFFLINE, "Bulb was removed from the snapshot")
+        if health.is_offline(this_bulb.name):
+            # skipped until a probe gets an answer, rather than waiting for it to time out again
+            return error_json(tinytuya.ERR_OFFLINE, "Bulb is offline")
+        result = await self.get(this_bulb).send(command, *args, **kwargs)
+        if not isinstance(result, Unchanged):
+            health.record(this_bulb.name, result)
+        return result
+
+    # Closes a bulb's connection, e.g. when its address or key changes
+    async def drop(self, name):
+        health.forget(name)
+        connection = self.connections.pop(name, None)
+        if connection is not None:
+            await connection.close(error_json(tinytuya.ERR_CONNECT, "Bulb connection was closed"))
+
+    def queue_stats(self):
+        return {name: connection.queue_stats() for name, connection in self.connections.items()}
+
+    def start_keepalive(self):
+        if self.keepalive_task is None:
+            self.keepalive_task = asyncio.create_task(self.keepalive_loop())
+
+    async def keepalive_loop(self):
+        while True:
+            await asyncio.gather(*[connection.keepalive() for connection in list(self.connections.values())])
+            await asyncio.sleep(KEEPALIVE_INTERVAL / 2)
+
+    def start_prober(self):
+        if self.prober is None:
+            self.prober = asyncio.create_task(self.probe_loop())
+
+    async def probe_loop(self):
+        while True:
+            await asyncio.sleep(PROBE_CHECK_INTERVAL)
+            await asyncio.gather(*[self.probe(name) for name in health.due()])
+
+    # Reads an offline bulb's status once, straight through its connection (past the offline check)
+    async def probe(self, name):
+        connection = self.connections.get(name)
+        if connection is None:
+            health.forget(name)
+            return
+        result = await connection.run("status", retries=1)
+        if command_failed(result):
+            health.probe_failed(name, result.get('Error'))
+        else:
+            health.answered(name)
+
+    async def close_all(self):
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+        if self.prober is not None:
+            self.prober.cancel()
+            self.prober = None
+        current_connections = list(self.connections.values())
+        self.connections.clear()
+        await asyncio.gather(*[connection.close() for connection in current_connections])
+
+
+connections = ConnectionManager()
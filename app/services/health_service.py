@@ -0,0 +1,105 @@
+from time import monotonic, time
+
+import tinytuya
+
+from app.services.log_service import get_logger
+
+# Counts each bulb's consecutive connection failures. After FAILURE_THRESHOLD of them the
+# bulb is marked offline and its commands fail straight away instead of waiting to time out.
+# An offline bulb is probed in the background, first after PROBE_INTERVAL and then twice as
+# long after each failed probe (up to MAX_PROBE_INTERVAL), until it answers
+
+FAILURE_THRESHOLD = 3
+PROBE_INTERVAL = 2
+MAX_PROBE_INTERVAL = 60
+
+# Only errors that mean the bulb could not be reached count as failures, not a bad reply.
+# error_json() gives the codes as strings
+UNREACHABLE_ERRORS = {str(tinytuya.ERR_CONNECT), str(tinytuya.ERR_TIMEOUT), str(tinytuya.ERR_OFFLINE)}
+
+log = get_logger("health")
+
+
+class BulbHealth:
+    def __init__(self):
+        self.online = True
+        self.failures = 0  # in a row
+        self.last_error = None
+        self.last_seen = None  # when the bulb last answered
+        self.offline_since = None
+        self.probe_interval = PROBE_INTERVAL
+        self.next_probe = None  # monotonic time of the next probe while offline
+        self.probes = 0
+
+
+class HealthTracker:
+    def __init__(self):
+        self.bulbs = {}  # kept by name, as the metrics are
+
+    def get(self, name):
+        health = self.bulbs.get(name)
+        if health is None:
+            health = self.bulbs[name] = BulbHealth()
+        return health
+
+    def is_offline(self, name):
+        health = self.bulbs.get(name)
+        return health is not None and not health.online
+
+    def record(self, name, result):
+        if result is None:
+            return  # sent without waiting for a reply, so nothing is known
+        if isinstance(result, dict) and result.get('Err') in UNREACHABLE_ERRORS:
+            self.failed(name, result.get('Error'))
+        else:
+            self.answered(name)
+
+    def answered(self, name):
+        health = self.get(name)
+        health.failures = 0
+        health.last_seen = time()
+        if not health.online:
+            log.info("bulb_online", bulb=name, offline_s=round(time() - health.offline_since, 1),
+                     probes=health.probes)
+            health.online = True
+            health.offline_since = None
+            health.next_probe = None
+            health.probe_interval = PROBE_INTERVAL
+            health.probes = 0
+
+    def failed(self, name, error):
+        health = self.get(name)
+        health.failures += 1
+        health.last_error = error
+        if health.online and health.failures >= FAILURE_THRESHOLD:
+            health.online = False
+            health.offline_since = time()
+            health.next_probe = monotonic() + health.probe_interval
+            log.warning("bulb_offline", bulb=name, failures=health.failures, error=error)
+
+    def probe_failed(self, name, error):
+        health = self.get(name)
+        health.failures += 1
+        health.last_error = error
+        health.probes += 1
+        health.probe_interval = min(health.probe_interval * 2, MAX_PROBE_INTERVAL)
+        health.next_probe = monotonic() + health.probe_interval
+
+    # Names of the offline bulbs whose next probe is due
+    def due(self):
+        now = monotonic()
+        return [name for name, health in self.bulbs.items() if not health.online and health.next_probe <= now]
+
+    def forget(self, name):
+        self.bulbs.pop(name, None)
+
+    def report(self):
+        now = monotonic()
+        return {name: {"online": health.online, "failures": health.failures, "last_error": health.last_error,
+                       "last_seen": health.last_seen, "offline_since": health.offline_since,
+                       "probes": health.probes,
+                       "next_probe_in": None if health.online else round(max(health.next_probe - now, 0), 1)}
+                for name, health in sorted(self.bulbs.items())}
+
+
+health = HealthTracker()
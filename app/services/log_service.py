@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from time import strftime, localtime
+
+# Log records go on a queue and a listener thread writes them out, so a slow stdout does not
+# block the event loop. A full queue drops (and counts) records instead of waiting.
+# Records are events with fields (bulb=..., latency_ms=...). Per bulb records are DEBUG.
+# LOG_LEVEL sets the level, and LOG_FORMAT=json writes one json object per line
+
+LOGGER_NAME = "tuya_api"
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = 10000
+
+
+def format_value(value):
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(item) for item in value)
+    if isinstance(value, float):
+        return str(round(value, 3))
+    value = str(value)
+    return '"{}"'.format(value.replace('"', '\\"')) if ' ' in value or not value else value
+
+
+class EventFormatter(logging.Formatter):
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.as_json:
+            entry = dict({"time": record.created, "level": record.levelname.lower(), "logger": record.name,
+                          "event": record.getMessage()}, **fields)
+            if record.exc_text:
+                entry["traceback"] = record.exc_text
+            return json.dumps(entry, default=str)
+        line = "{} {:<7} {}".format(strftime('%X', localtime(record.created)), record.levelname,
+                                    record.getMessage())
+        if fields:
+            line += " " + " ".join("{}={}".format(key, format_value(value)) for key, value in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # the fields are formatted by the listener, off the event loop
+        record.exc_text = self.formatter.formatException(record.exc_info) if record.exc_info else None
+        record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class EventLogger:
+    def __init__(self, logger):
+        self.logger = logger
+
+    def enabled(self, level=logging.DEBUG):
+        return self.logger.isEnabledFor(level)
+
+    def event(self, level, event, fields, exc_info=None):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"fields": fields}, exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self.event(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.event(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.event(logging.WARNING, event, fields)
+
+    def error(self, event, exc_info=None, **fields):
+        self.event(logging.ERROR, event, fields, exc_info=exc_info)
+
+
+class LogService:
+    def __init__(self, level=LOG_LEVEL, log_format=LOG_FORMAT):
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.handler.setFormatter(logging.Formatter())
+        self.listener = None
+        self.log_format = log_format
+
+        self.root = logging.getLogger(LOGGER_NAME)
+        self.root.setLevel(level)
+        self.root.addHandler(self.handler)
+        self.root.propagate = False
+
+    def get(self, name):
+        return EventLogger(self.root.getChild(name))
+
+    def set_level(self, level):
+        self.root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    def start(self, *handlers):
+        if self.listener is not None:
+            return
+        if not handlers:
+            output = logging.StreamHandler()
+            output.setFormatter(EventFormatter(as_json=self.log_format == 'json'))
+            handlers = (output,)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    # Writes out whatever is still queued, then stops the listener thread
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+logs = LogService()
+
+
+def get_logger(name):
+    return logs.get(name)
@@ -0,0 +1,137 @@
+from bisect import bisect_left
+
+from app.services.health_service import health
+from app.services.log_service import logs
+
+# Counters and histograms for /metrics, in the Prometheus text format. Recording a value is
+# a list index and an addition, so they can sit on the hot path. The counters that the
+# connections and clients already keep (retries, reconnects, coalesced...) are only read
+# when /metrics is scraped
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SKEW_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels + "," if labels else "", bound, cumulative))
+        labels = "{{{}}}".format(labels) if labels else ""
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+
+class BulbStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.failures = 0
+        self.in_flight = 0
+
+
+class SceneStats:
+    def __init__(self):
+        self.tick_duration = Histogram()
+        self.overruns = 0
+
+
+def label(key, value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{}="{}"'.format(key, value)
+
+
+class Metrics:
+    def __init__(self):
+        # kept by name, so the counts carry on when a connection is rebuilt or a scene restarted
+        self.bulbs = {}
+        self.scenes = {}
+        self.lightning_skew = Histogram(SKEW_BUCKETS)
+
+    def bulb(self, name):
+        stats = self.bulbs.get(name)
+        if stats is None:
+            stats = self.bulbs[name] = BulbStats()
+        return stats
+
+    def scene(self, name):
+        stats = self.scenes.get(name)
+        if stats is None:
+            stats = self.scenes[name] = SceneStats()
+        return stats
+
+    def render(self, connections):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples:
+                lines.append("{}{{{}}} {}".format(name, labels, value) if labels else "{} {}".format(name, value))
+
+        bulbs = sorted(self.bulbs.items())
+        lines.append("# HELP tuya_command_duration_seconds Time taken by each bulb command")
+        lines.append("# TYPE tuya_command_duration_seconds histogram")
+        for name, stats in bulbs:
+            lines.extend(stats.latency.render("tuya_command_duration_seconds", label("bulb", name)))
+        metric("tuya_command_failures_total", "counter", "Bulb commands that returned an error",
+               [(label("bulb", name), stats.failures) for name, stats in bulbs])
+        metric("tuya_commands_in_flight", "gauge", "Bulb commands being sent right now",
+               [(label("bulb", name), stats.in_flight) for name, stats in bulbs])
+
+        current = sorted(connections.connections.items())
+        for name, metric_type, help_text, value in (
+                ("tuya_command_retries_total", "counter", "Bulb requests sent again after a failure",
+                 lambda connection: connection.client.retries),
+                ("tuya_command_timeouts_total", "counter", "Bulb requests that got no reply in time",
+                 lambda connection: connection.client.timeouts),
+                ("tuya_socket_reconnects_total", "counter", "Bulb sockets dropped so they could be reopened",
+                 lambda connection: connection.client.reconnects),
+                ("tuya_commands_coalesced_total", "counter", "Commands replaced by a newer one before being sent",
+                 lambda connection: connection.coalesced),
+                ("tuya_commands_unchanged_total", "counter", "Commands not sent as the bulb already had the values",
+                 lambda connection: connection.unchanged),
+                ("tuya_commands_pending", "gauge", "Commands waiting in the bulb's queue",
+                 lambda connection: len(connection.pending)),
+                ("tuya_reply_time_seconds", "gauge", "Running average of the time the bulb takes to reply",
+                 lambda connection: "NaN" if connection.client.rtt is None else round(connection.client.rtt, 4)),
+                ("tuya_reply_timeout_seconds", "gauge", "How long the next request waits for the bulb to reply",
+                 lambda connection: round(connection.client.reply_timeout, 4))):
+            metric(name, metric_type, help_text,
+                   [(label("bulb", bulb_name), value(connection)) for bulb_name, connection in current])
+
+        metric("tuya_bulb_online", "gauge", "1 if the bulb is being sent commands, 0 while it is offline",
+               [(label("bulb", name), int(bulb_health.online)) for name, bulb_health in sorted(health.bulbs.items())])
+
+        scenes = sorted(self.scenes.items())
+        lines.append("# HELP scene_tick_duration_seconds Time from a scene tick being due to the scene finishing it")
+        lines.append("# TYPE scene_tick_duration_seconds histogram")
+        for name, stats in scenes:
+            lines.extend(stats.tick_duration.render("scene_tick_duration_seconds", label("scene", name)))
+        metric("scene_tick_overruns_total", "counter", "Scene ticks that took longer than the scene's wait time",
+               [(label("scene", name), stats.overruns) for name, stats in scenes])
+        lines.append("# HELP lightning_flash_skew_seconds Time between the first and last bulb of a lightning "
+                     "flash, not counting intended delays")
+        lines.append("# TYPE lightning_flash_skew_seconds histogram")
+        lines.extend(self.lightning_skew.render("lightning_flash_skew_seconds"))
+
+        metric("tuya_log_records_dropped_total", "counter", "Log records dropped as the log queue was full",
+               [("", logs.handler.dropped)])
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,202 @@
+import asyncio
+from contextvars import ContextVar
+from itertools import count
+from math import ceil
+from time import monotonic
+
+from app.services.log_service import get_logger
+from app.services.metrics_service import metrics
+
+# Scenes run as asyncio tasks, so stopping one cancels it straight away instead of
+# waiting for it to notice a flag. Stopping waits for the scene to finish its cleanup
+# (so it has let go of its bulbs), but never longer than STOP_TIMEOUT
+#
+# Each scene owns the bulbs it was started with, and a bulb has at most one owner. Starting
+# a scene only stops the scenes that own any of its bulbs, so scenes on different bulbs run
+# side by side. A direct command to a bulb takes it away from its scene (which carries on
+# with the rest of its bulbs, or stops if it has none left). Bulbs are owned by id, which
+# stays the same when a bulb is renamed in the snapshot
+
+STOP_TIMEOUT = 2
+
+current_clock = ContextVar('current_clock', default=None)
+
+log = get_logger("scenes")
+
+
+# Paces a scene on the monotonic clock. Each tick is due one period after the previous
+# tick was due (not after the scene finished sending), so scenes do not drift over long
+# runs. Waiting sleeps until the tick is due or the scene is stopped, whichever comes first
+
+class SceneClock:
+    def __init__(self, name=None, bulbs=None):
+        self.name = name
+        self.stop_event = asyncio.Event()
+        self.deadline = monotonic()
+        self.waiting = False
+        self.stats = metrics.scene(name) if name else None
+        # the bulbs the scene still owns by id, or None for any bulb
+        self.bulbs = None if bulbs is None else {this_bulb.dev_id: this_bulb for this_bulb in bulbs}
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def owns(self, this_bulb):
+        return self.bulbs is None or this_bulb.dev_id in self.bulbs
+
+    # Returns True when the deadline is reached, or False if the scene was stopped first
+    async def wait_until(self, deadline):
+        delay = deadline - monotonic()
+        if self.stopped or delay <= 0:
+            await asyncio.sleep(0)
+            return not self.stopped
+
+        self.waiting = True
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), delay)
+            return False
+        except asyncio.TimeoutError:
+            return True
+        finally:
+            self.waiting = False
+
+    async def tick(self, period):
+        now = monotonic()
+        if self.stats is not None:
+            self.stats.tick_duration.observe(now - self.deadline)
+        self.deadline += period
+        late = now - self.deadline
+        if late > 0 and period > 0:
+            # the bulbs took longer than a tick, so skip the ticks we missed rather than rushing through them
+            self.deadline += ceil(late / period) * period
+            if self.stats is not None:
+                self.stats.overruns += 1
+        elif late > 0:
+            self.deadline = now  # no wait time, so the next tick is due straight away
+        return await self.wait_until(self.deadline)
+
+    # Yields straight away, then once every period until the scene is stopped
+    async def ticks(self, period):
+        self.deadline = monotonic()
+        while not self.stopped:
+            yield
+            if not await self.tick(period):
+                return
+
+
+# The clock of the scene that is running, or a new one if it was not started by the SceneManager
+
+def scene_clock():
+    clock = current_clock.get()
+    return clock if clock is not None else SceneClock()
+
+
+class SceneManager:
+    def __init__(self):
+        self.scenes = {}
+        self.clocks = {}
+        self.owners = {}  # bulb id: id of the scene that owns it
+        self.scene_ids = count(1)
+        # held while scenes are started, stopped or have bulbs taken from them, so a scene
+        # started while another start is still stopping the old owners cannot end up running too
+        self.lock = asyncio.Lock()
+
+    # Stops the scenes using any of the bulbs, then starts this one with them. A scene
+    # without any bulbs is not started, and None is returned instead of its id
+    async def start(self, name, scene, scene_bulbs):
+        if not scene_bulbs:
+            scene.close()
+            return None
+        async with self.lock:
+            await self.stop(self.owning(scene_bulbs))
+            return self.run(name, scene, scene_bulbs)
+
+    # Starts the scene's task, with a clock that owns the bulbs
+    def run(self, name, scene, scene_bulbs):
+        scene_id = next(self.scene_ids)
+        clock = SceneClock(name, scene_bulbs)
+        # the task copies the current context, so the scene finds its clock through current_clock
+        token = current_clock.set(clock)
+        try:
+            task = asyncio.create_task(scene, name="{}-{}".format(name, scene_id))
+        finally:
+            current_clock.reset(token)
+        self.scenes[scene_id] = task
+        self.clocks[scene_id] = clock
+        for dev_id in clock.bulbs:
+            self.owners[dev_id] = scene_id
+        task.add_done_callback(lambda finished: self.finished(scene_id, finished))
+        return scene_id
+
+    # The endpoint has already returned by the time a scene fails, so its error is only logged
+    def finished(self, scene_id, task):
+        self.forget(scene_id)
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            log.error("scene_failed", exc_info=(type(error), error, error.__traceback__), scene=task.get_name(),
+                      error="{}: {}".format(type(error).__name__, error))
+
+    def forget(self, scene_id):
+        self.scenes.pop(scene_id, None)
+        clock = self.clocks.pop(scene_id, None)
+        if clock is not None:
+            for dev_id in clock.bulbs:
+                if self.owners.get(dev_id) == scene_id:
+                    del self.owners[dev_id]
+
+    def owning(self, this_bulbs):
+        return {self.owners[this_bulb.dev_id] for this_bulb in this_bulbs if this_bulb.dev_id in self.owners}
+
+    # Takes the bulbs away from the scenes that own them, and stops any scene left without bulbs
+    async def release(self, this_bulbs):
+        async with self.lock:
+            emptied = []
+            for this_bulb in this_bulbs:
+                scene_id = self.owners.pop(this_bulb.dev_id, None)
+                if scene_id is None:
+                    continue
+                clock = self.clocks[scene_id]
+                clock.bulbs.pop(this_bulb.dev_id, None)
+                if not clock.bulbs:
+                    emptied.append(scene_id)
+            if emptied:
+                await self.stop(emptied)
+
+    def running(self):
+        return list(self.scenes)
+
+    def describe(self):
+        return [{"scene_id": scene_id, "name": clock.name,
+                 "bulbs": sorted(this_bulb.name for this_bulb in clock.bulbs.values())}
+                for scene_id, clock in self.clocks.items()]
+
+    async def stop(self, scene_ids, timeout=STOP_TIMEOUT):
+        tasks = []
+        for scene_id in scene_ids:
+            if scene_id not in self.scenes:
+                continue
+            task, clock = self.scenes[scene_id], self.clocks[scene_id]
+            # a scene waiting for its next tick wakes up and finishes on its own,
+            # one in the middle of talking to a bulb is cancelled
+            clock.stop()
+            if not clock.waiting:
+                task.cancel()
+            tasks.append(task)
+        if not tasks:
+            return True
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            log.warning("scene_stop_timeout", scene=task.get_name(), timeout=timeout)
+        return not pending
+
+    async def stop_all(self, timeout=STOP_TIMEOUT):
+        async with self.lock:
+            return await self.stop(self.running(), timeout)
+
+
+scene_manager = SceneManager()
@@ -0,0 +1,112 @@
+import asyncio
+import os
+
+from app.models.bulb import (bulb_config, bulbs, new_bulb, read_snapshot, registry, set_up_defaults,
+                             snapshot_path, update_bulb)
+from app.services.connection_service import connections
+from app.services.log_service import get_logger
+from app.services.scene_service import scene_manager
+from app.services.startup_service import startup
+from app.services.status_service import status_cache
+
+# Checks the snapshot file every SNAPSHOT_POLL_INTERVAL and applies only the bulbs that were
+# added, removed or changed (matched by device id). Changed bulbs keep their BulbObject, and
+# only get a new connection if their address, key, version, port or name changed
+
+SNAPSHOT_POLL_INTERVAL = 2
+
+log = get_logger("snapshot")
+
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class SnapshotWatcher:
+    def __init__(self):
+        self.path = None
+        self.modified = None
+        self.watcher = None
+        self.reloads = 0
+
+    def start(self, path=None):
+        if self.watcher is None:
+            self.path = path or snapshot_path()
+            self.modified = modified_time(self.path)
+            self.watcher = asyncio.create_task(self.watch_loop())
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+
+    async def watch_loop(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_POLL_INTERVAL)
+            modified = modified_time(self.path)
+            if modified is None or modified == self.modified:
+                continue
+            # only try each version of the file once, a half written one is picked up when it is finished
+            self.modified = modified
+            try:
+                await self.reload()
+            except (OSError, ValueError, KeyError) as error:
+                log.warning("snapshot_reload_failed", snapshot=self.path,
+                            error="{}: {}".format(type(error).__name__, error))
+                continue
+            if startup.state == "failed":
+                # the snapshot could not be loaded at startup, and now it has been
+                startup.state = "ready"
+                startup.error = None
+
+    # Applies the differences between the snapshot and the registry, and returns what changed
+    async def reload(self):
+        configs = await asyncio.to_thread(read_snapshot, self.path)
+        wanted = {}
+        for bulb in configs:
+            wanted[bulb['id']] = bulb
+
+        current = {this_bulb.dev_id: this_bulb for this_bulb in bulbs}
+        added = [bulb for dev_id, bulb in wanted.items() if dev_id not in current]
+        removed = [this_bulb for dev_id, this_bulb in current.items() if dev_id not in wanted]
+        changed = [this_bulb for dev_id, this_bulb in current.items()
+                   if dev_id in wanted and this_bulb.config != bulb_config(wanted[dev_id])]
+
+        # scenes let go of the removed bulbs, and stop if they have none left
+        await scene_manager.release(removed)
+        for this_bulb in removed:
+            this_bulb.removed = True
+            registry.remove(this_bulb)
+            status_cache.forget(this_bulb.name)
+            await connections.drop(this_bulb.name)
+
+        for this_bulb in changed:
+            old_name = this_bulb.name
+            if update_bulb(this_bulb, wanted[this_bulb.dev_id]):
+                status_cache.forget(old_name)
+                await connections.drop(old_name)
+
+        new_bulbs = await asyncio.gather(*[asyncio.to_thread(new_bulb, bulb) for bulb in added])
+        for this_bulb in new_bulbs:
+            registry.add(this_bulb)
+
+        if added or removed or changed:
+            registry.reindex()
+            set_up_defaults()
+            self.reloads += 1
+            # connect the new and changed bulbs in the background, as the startup warm-up does
+            for this_bulb in new_bulbs + changed:
+                status_cache.refresh(this_bulb)
+
+        result = {"added": [this_bulb.name for this_bulb in new_bulbs],
+                  "removed": [this_bulb.name for this_bulb in removed],
+                  "changed": [this_bulb.name for this_bulb in changed]}
+        log.info("snapshot_reloaded", snapshot=self.path, **result)
+        return result
+
+
+snapshot_watcher = SnapshotWatcher()
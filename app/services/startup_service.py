@@ -0,0 +1,70 @@
+import asyncio
+from time import perf_counter
+
+from app.models.bulb import bulbs, new_bulb, read_snapshot, registry, set_up_defaults, snapshot_path
+from app.services.log_service import get_logger
+from app.services.status_service import status_cache
+
+# Loads the snapshot when the app starts (off the event loop), then reads every bulb at once
+# to open its socket, detect its type and fill the status cache. The warm-up waits at most
+# WARMUP_TIMEOUT, and bulbs that have not answered by then carry on in the background
+
+WARMUP_TIMEOUT = 5
+
+log = get_logger("startup")
+
+
+class Startup:
+    def __init__(self):
+        self.state = "starting"  # then "ready", or "failed" if the snapshot could not be loaded
+        self.snapshot = None
+        self.error = None
+        self.warm = []
+        self.cold = []
+        self.load_ms = None
+        self.warm_up_ms = None
+
+    async def load(self, path=None):
+        self.snapshot = path or snapshot_path()
+        start = perf_counter()
+        configs = await asyncio.to_thread(read_snapshot, self.snapshot)
+        new_bulbs = await asyncio.gather(*[asyncio.to_thread(new_bulb, config) for config in configs])
+        for this_bulb in new_bulbs:
+            registry.add(this_bulb)
+        set_up_defaults()
+        self.load_ms = round((perf_counter() - start) * 1000, 1)
+
+    async def warm_up(self, timeout=WARMUP_TIMEOUT):
+        start = perf_counter()
+        tasks = {asyncio.create_task(status_cache.get(this_bulb, max_age=0)): this_bulb for this_bulb in bulbs}
+        done, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+        for task in pending:
+            task.cancel()  # only stops waiting, the reads are shielded and carry on
+        answered = {tasks[task].name for task in done if task.exception() is None and task.result()['online']}
+        self.warm = [this_bulb.name for this_bulb in bulbs if this_bulb.name in answered]
+        self.cold = [this_bulb.name for this_bulb in bulbs if this_bulb.name not in answered]
+        self.warm_up_ms = round((perf_counter() - start) * 1000, 1)
+
+    async def start(self, timeout=WARMUP_TIMEOUT):
+        try:
+            await self.load()
+        except (OSError, ValueError, KeyError) as error:
+            self.state = "failed"
+            self.error = "{}: {}".format(type(error).__name__, error)
+            log.error("snapshot_failed", snapshot=self.snapshot, error=self.error)
+            return
+        await self.warm_up(timeout)
+        self.state = "ready"
+        log.info("startup_done", bulbs=len(bulbs), warm=len(self.warm), cold=self.cold, load_ms=self.load_ms,
+                 warm_up_ms=self.warm_up_ms)
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def report(self):
+        return {"state": self.state, "snapshot": self.snapshot, "error": self.error, "bulbs": len(bulbs),
+                "warm": self.warm, "cold": self.cold, "load_ms": self.load_ms, "warm_up_ms": self.warm_up_ms}
+
+
+startup = Startup()
@@ -0,0 +1,137 @@
+import asyncio
+from time import time
+
+from tinytuya import BulbDevice
+
+from app.models.bulb import BulbObject, bulbs
+from app.services.connection_service import command_failed, connections
+
+# Bulb status reads are served from memory, and only go to the bulb once the cached status
+# is older than STATUS_TTL. Concurrent reads of the same bulb share one status() call, and
+# a background task refreshes every bulb at once every REFRESH_INTERVAL (after the first
+# read at startup), so reads are usually answered without waiting on the bulbs at all.
+# Writes made through the API (and updates the bulb pushes) are picked up from the
+# connection's shadow state as soon as they are newer than the cached status
+
+STATUS_TTL = 5
+REFRESH_INTERVAL = 30
+
+
+class StatusCache:
+    def __init__(self, ttl=STATUS_TTL):
+        self.ttl = ttl
+        self.entries = {}  # name: status
+        self.in_flight = {}  # name: task reading the bulb
+        self.refresher = None
+
+    async def get(self, this_bulb: BulbObject, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        entry = self.entries.get(this_bulb.name)
+        client = self.newer_shadow(this_bulb, entry)
+        if client is not None:
+            entry = self.store(this_bulb, dict(client.last_status), client.last_status_time)
+        if entry is not None and time() - entry['updated'] <= max_age:
+            return self.with_age(entry)
+
+        # shielded, so a reader giving up does not cancel the read for everyone else
+        return self.with_age(await asyncio.shield(self.refresh(this_bulb)))
+
+    # Starts reading the bulb, unless a read is already under way, and returns the read's task
+    def refresh(self, this_bulb: BulbObject):
+        name = this_bulb.name
+        task = self.in_flight.get(name)
+        if task is None:
+            task = asyncio.create_task(self.read(this_bulb))
+            self.in_flight[name] = task
+            task.add_done_callback(lambda finished: self.in_flight.pop(name, None)
+                                   if self.in_flight.get(name) is finished else None)
+        return task
+
+    def forget(self, name):
+        self.entries.pop(name, None)
+        task = self.in_flight.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    async def get_all(self, max_age=None):
+        return await asyncio.gather(*[self.get(this_bulb, max_age) for this_bulb in bulbs])
+
+    async def read(self, this_bulb: BulbObject):
+        result = await connections.send(this_bulb, "status")
+        if command_failed(result):
+            # keep the last known state, so clients can still show something
+            previous = self.entries.get(this_bulb.name)
+            return self.store(this_bulb, previous["dps"] if previous is not None else {}, time(), result)
+        return self.store(this_bulb, result.get('dps', {}) if isinstance(result, dict) else {}, time())
+
+    def store(self, this_bulb: BulbObject, dps, updated, error=None):
+        entry = {
+            "name": this_bulb.name,
+            "id": this_bulb.dev_id,
+            "group": this_bulb.group,
+            "online": error is None,
+            "updated": updated,
+            "dps": dps,
+        }
+        if error is not None:
+            entry["error"] = error
+        entry.update(self.describe(this_bulb, dps))
+        self.entries[this_bulb.name] = entry
+        return entry
+
+    # The bulb's client, if what it last confirmed is newer than the cached status
+    @staticmethod
+    def newer_shadow(this_bulb: BulbObject, entry):
+        connection = connections.connections.get(this_bulb.name)
+        if connection is None or connection.device is not this_bulb.bulb:
+            return None
+        client = connection.client
+        if not client.last_status_time or (entry is not None and client.last_status_time <= entry['updated']):
+            return None
+        return client
+
+    # The readable state of the bulb, from its data points
+    @staticmethod
+    def describe(this_bulb: BulbObject, dps):
+        device = this_bulb.bulb
+        if not device.bulb_configured:
+            return {}
+        dpset = device.dpset
+        state = {
+            "power": dps.get(dpset['switch']),
+            "mode": dps.get(dpset['mode']),
+            "brightness": dps.get(dpset['brightness']),
+        }
+        colour = dps.get(dpset['colour']) if dpset['colour'] else None
+        if colour:
+            try:
+                state["colour"] = BulbDevice.hexvalue_to_rgb(colour, dpset['value_hexformat'])
+            except (ValueError, TypeError):
+                state["colour"] = None
+        return state
+
+    @staticmethod
+    def with_age(entry):
+        return dict(entry, age=round(time() - entry['updated'], 3))
+
+    def start_refresher(self):
+        if self.refresher is None:
+            self.refresher = asyncio.create_task(self.refresh_loop())
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            await self.get_all(max_age=0)
+
+    async def stop_refresher(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+        # the reads are shielded from their readers, so cancel them here before the connections close
+        reads = list(self.in_flight.values())
+        for task in reads:
+            task.cancel()
+        await asyncio.gather(*reads, return_exceptions=True)
+
+
+status_cache = StatusCache()
@@ -0,0 +1,120 @@
+import asyncio
+from time import perf_counter
+
+from app.models.bulb import BulbObject, registry
+from app.services.connection_service import command_failed, connections
+from app.services.log_service import get_logger
+from app.services.scene_service import scene_manager
+
+# Colour frames streamed over a websocket (e.g. for music or game lighting), at a rate one
+# HTTP request per frame could not keep up with. Each message is a frame for any number of
+# bulbs, {"Den Light": [255, 0, 0], "Lamps": [0, 0, 255]}, by name, id or group.
+#
+# Each bulb is sent one frame at a time, at the rate it can take them (no faster than
+# STREAM_MAX_FPS). A frame that arrives while the bulb is still busy replaces the one waiting,
+# so the bulb always gets the newest colour and frames never pile up. Every STATS_INTERVAL,
+# the client is sent how many frames each bulb was sent, dropped and failed
+
+STREAM_MAX_FPS = 30
+STATS_INTERVAL = 1
+
+log = get_logger("stream")
+
+
+def parse_colour(name, colour):
+    if (not isinstance(colour, (list, tuple)) or len(colour) != 3
+            or not all(isinstance(value, int) and 0 <= value <= 255 for value in colour)):
+        raise ValueError("Frame for {} should be [red, green, blue], from 0 to 255".format(name))
+    return tuple(colour)
+
+
+class BulbStream:
+    def __init__(self, this_bulb: BulbObject):
+        self.bulb = this_bulb
+        self.frame = None  # the newest frame not sent yet
+        self.ready = asyncio.Event()
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0  # replaced by a newer frame before they were sent
+        self.failed = 0
+        self.latency_ms = None
+        self.reported_sent = 0
+        self.sender = asyncio.create_task(self.send_loop())
+
+    def push(self, colour):
+        self.received += 1
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = colour
+        self.ready.set()
+
+    async def send_loop(self):
+        interval = 1 / STREAM_MAX_FPS
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            colour, self.frame = self.frame, None
+            start = perf_counter()
+            # a stale frame is not worth retrying, the next one will be along shortly
+            result = await connections.send(self.bulb, "set_colour", *colour, retries=1)
+            elapsed = perf_counter() - start
+            self.latency_ms = round(elapsed * 1000, 1)
+            if command_failed(result):
+                self.failed += 1
+            else:
+                self.sent += 1
+            if elapsed < interval:
+                await asyncio.sleep(interval - elapsed)
+
+    def stats(self, period):
+        fps = round((self.sent - self.reported_sent) / period, 1)
+        self.reported_sent = self.sent
+        return {"received": self.received, "sent": self.sent, "dropped": self.dropped, "failed": self.failed,
+                "latency_ms": self.latency_ms, "fps": fps}
+
+    async def close(self):
+        self.sender.cancel()
+        await asyncio.gather(self.sender, return_exceptions=True)
+
+
+# The bulbs of one websocket. A bulb is taken from its scene when its first frame arrives
+class FrameStream:
+    def __init__(self):
+        self.bulbs = {}  # name: BulbStream
+        self.unknown = 0  # frames for names that matched no bulb
+        self.last_report = perf_counter()
+
+    async def push(self, frames):
+        if not isinstance(frames, dict):
+            raise ValueError("A frame should be an object of bulb name: [red, green, blue]")
+        colours = [(name, parse_colour(name, colour)) for name, colour in frames.items()]
+        for name, colour in colours:
+            matched = registry.lookup(name)
+            if not matched:
+                self.unknown += 1
+            for this_bulb in matched:
+                stream = self.bulbs.get(this_bulb.name)
+                if stream is None or stream.bulb is not this_bulb:
+                    if stream is not None:
+                        await stream.close()  # the name now belongs to another bulb (after a reload)
+                    await scene_manager.release([this_bulb])
+                    stream = self.bulbs[this_bulb.name] = BulbStream(this_bulb)
+                stream.push(colour)
+
+    def stats(self):
+        now = perf_counter()
+        period, self.last_report = now - self.last_report, now
+        return {"bulbs": {name: stream.stats(period) for name, stream in self.bulbs.items()},
+                "unknown": self.unknown}
+
+    # Sends the stats to the client every STATS_INTERVAL, until cancelled
+    async def report_loop(self, send_json):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            await send_json({"stats": self.stats()})
+
+    async def close(self):
+        await asyncio.gather(*[stream.close() for stream in self.bulbs.values()])
+        log.info("stream_closed", bulbs=len(self.bulbs),
+                 frames=sum(stream.received for stream in self.bulbs.values()),
+                 sent=sum(stream.sent for stream in self.bulbs.values()))
@@ -0,0 +1,119 @@
+import asyncio
+from random import choice
+from time import perf_counter
+from typing import NamedTuple
+
+import Colours
+from app.models.bulb import BulbObject, MultiColourSceneClass, RandomColourSceneClass, RgbColour, bulbs, registry
+from app.services.colour_service import final_colours_batch
+from app.services.connection_service import connections
+from app.services.log_service import get_logger
+from app.services.scene_service import scene_clock
+
+# A scene request is compiled once into a Timeline: a table of steps, each holding the final
+# colour of every bulb. play() runs any timeline, sending one step per tick and looping.
+# A frame with more than one colour picks one of them at random each time it is played
+
+log = get_logger("scenes")
+
+
+class Frame(NamedTuple):
+    bulb: BulbObject
+    colours: tuple  # ((red, green, blue), ...), with the bulb's bright_mul already applied
+
+
+class Step(NamedTuple):
+    frames: tuple
+
+
+class Timeline(NamedTuple):
+    name: str
+    tick: float  # seconds between steps
+    steps: tuple
+
+
+# Works out the final colours of (RgbColour, bright_mul) rows in one batch, and returns them
+# as tuples in the same order
+def final_colour_tuples(rows):
+    return [tuple(final_cols) for final_cols in
+            final_colours_batch([(col.red, col.green, col.blue, bright_mul) for col, bright_mul in rows])]
+
+
+def compile_xmas(wait_time):
+    # the Lights go red while the lamps go dark green, then they swap to green and dark red
+    steps = []
+    for index, (light, lamp) in enumerate((((255, 0, 0), (0, 100, 0)), ((0, 255, 0), (100, 0, 0)))):
+        frames = tuple(Frame(this_bulb, (light if "Light" in this_bulb.name else lamp,)) for this_bulb in bulbs)
+        steps.append(Step(frames))
+    return Timeline("xmas_scene", wait_time, tuple(steps))
+
+
+def compile_multi_colour(multi_class: MultiColourSceneClass):
+    # bulb list i starts on colour i, and every list moves on one colour each tick
+    dispatch_lists = [registry.resolve(bulb_list, only_toggled=False) for bulb_list in multi_class.bulb_lists]
+    colour_list = list(multi_class.colour_list)
+    colour_list += [RgbColour(**Colours.WHITE)] * (len(dispatch_lists) - len(colour_list))
+
+    rows = []
+    for step in range(len(colour_list)):
+        for i, dispatch_list in enumerate(dispatch_lists):
+            col = colour_list[(i + step) % len(colour_list)]
+            rows.extend((col, this_toggle.get('bright_mul', 1.0)) for this_bulb, this_toggle in dispatch_list)
+    step_colours = iter(final_colour_tuples(rows))
+
+    steps = []
+    for step in range(len(colour_list)):
+        frames = tuple(Frame(this_bulb, (next(step_colours),))
+                       for dispatch_list in dispatch_lists for this_bulb, this_toggle in dispatch_list)
+        steps.append(Step(frames))
+    return Timeline("multi_colour_scene", multi_class.wait_time, tuple(steps))
+
+
+def compile_random_colour(random_class: RandomColourSceneClass):
+    # one step, where every bulb picks one of its final colours each tick
+    dispatch_list = registry.resolve(random_class.toggles, only_toggled=False)
+    colour_list = list(random_class.colour_list)
+    if not colour_list:
+        return Timeline("random_colour_scene", random_class.wait_time, ())
+    final_cols = iter(final_colour_tuples([(col, this_toggle.get('bright_mul', 1.0))
+                                           for this_bulb, this_toggle in dispatch_list for col in colour_list]))
+    frames = tuple(Frame(this_bulb, tuple(next(final_cols) for col in colour_list))
+                   for this_bulb, this_toggle in dispatch_list)
+    return Timeline("random_colour_scene", random_class.wait_time, (Step(frames),))
+
+
+# Sends the frame's colour, unless its bulb is no longer the scene's
+
+async def play_frame(clock, frame: Frame, retries=None):
+    if not clock.owns(frame.bulb):
+        return None  # taken for something else, possibly while an earlier frame of this step was being sent
+    colour = frame.colours[0] if len(frame.colours) == 1 else choice(frame.colours)
+    start = perf_counter()
+    result = await connections.send(frame.bulb, "set_colour", *colour, retries=retries)
+    if log.enabled():
+        log.debug("bulb_set", bulb=frame.bulb.name, colour=colour,
+                  latency_ms=round((perf_counter() - start) * 1000, 1))
+    return result
+
+
+# Plays the timeline's steps in order, one per tick, looping until the scene is stopped.
+# With parallel set, every bulb in a step is sent its colour at once, otherwise one at a time.
+# retries is the retry limit of the scene's commands (the bulbs' own limit when None)
+
+async def play(timeline: Timeline, parallel=True, retries=None):
+    clock = scene_clock()
+    log.info("scene_started", scene=timeline.name, wait=timeline.tick, steps=len(timeline.steps))
+    try:
+        if not timeline.steps:
+            return
+        index = 0
+        async for tick in clock.ticks(timeline.tick):
+            frames = timeline.steps[index].frames
+            if parallel:
+                await asyncio.gather(*[play_frame(clock, frame, retries) for frame in frames])
+            else:
+                for frame in frames:
+                    await play_frame(clock, frame, retries)
+            index = (index + 1) % len(timeline.steps)
+    finally:
+        log.info("scene_stopped", scene=timeline.name, wait=timeline.tick)
@@ -0,0 +1,302 @@
+import asyncio
+import hmac
+import json
+import os
+import struct
+from contextvars import ContextVar
+from hashlib import md5, sha256
+from time import perf_counter, time
+
+import tinytuya
+from tinytuya import AESCipher, DecodeError, MessagePayload, TuyaMessage, error_json, pack_message, parse_header, \
+    unpack_message
+
+# Talks the Tuya local protocol (3.1 - 3.5) over asyncio streams, so the event loop can drive
+# every bulb at once without a thread per command. The framing, CRC/HMAC and AES helpers come
+# from tinytuya, only the socket handling is done here. Failures are returned as tinytuya style
+# error dicts (with an 'Err' code), the same as the blocking tinytuya calls
+
+TCP_PORT = 6668
+
+HEADER_LEN_55AA = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_55AA)
+HEADER_LEN_6699 = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_6699)
+
+# Each bulb keeps a running average of how long it takes to reply (and how much that varies),
+# as TCP does, and waits for a reply for the average plus RTT_VARIANCE_WEIGHT times the
+# variation, between MIN_REPLY_TIMEOUT and the client's timeout. So a dead request to a fast
+# bulb gives up in about a second, while a slow bulb still gets the time it usually needs.
+# Each timeout doubles the wait (up to MAX_BACKOFF times, and never past the client's timeout)
+# until the bulb replies again, so a bulb that has slowed down is not timed out forever. Until
+# a bulb has replied, the client's timeout is used
+RTT_GAIN = 1 / 8
+RTT_VARIANCE_GAIN = 1 / 4
+RTT_VARIANCE_WEIGHT = 4
+MIN_REPLY_TIMEOUT = 1.0
+MAX_BACKOFF = 4
+
+# The timeout and retry limit of the request being sent, if the caller set them. They are set
+# for one command (see BulbConnection.run), instead of changing the client for everyone
+request_limits = ContextVar('request_limits', default=(None, None))
+
+
+class TuyaClient:
+    def __init__(self, dev_id, address, local_key, version, timeout=5, retry_limit=1, port=TCP_PORT):
+        self.dev_id = dev_id
+        self.address = address
+        self.port = port
+        self.real_local_key = local_key.encode('latin1')
+        self.local_key = self.real_local_key
+        self.version = float(version)
+        self.version_bytes = str(self.version).encode('latin1')
+        self.version_header = self.version_bytes + tinytuya.PROTOCOL_3x_HEADER
+        self.timeout = timeout
+        self.retry_limit = retry_limit
+        self.reader = None
+        self.writer = None
+        self.seqno = 1
+        self.lock = asyncio.Lock()  # one request in flight per bulb
+        self.last_status = {}
+        self.last_status_time = 0  # when the bulb last confirmed last_status, 0 after a reconnect
+        self.reconnects = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.rtt = None  # smoothed time to reply, in seconds
+        self.rtt_variance = None
+        self.backoff = 1  # doubled on each timeout, reset by a reply
+
+    # How long to wait for the bulb, worked out from how quickly it has been replying
+    @property
+    def reply_timeout(self):
+        if self.rtt is None:
+            return self.timeout
+        timeout = max(self.rtt + RTT_VARIANCE_WEIGHT * self.rtt_variance, MIN_REPLY_TIMEOUT)
+        return min(timeout * self.backoff, self.timeout)
+
+    def observe_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+            self.rtt_variance = rtt / 2
+        else:
+            self.rtt_variance += RTT_VARIANCE_GAIN * (abs(self.rtt - rtt) - self.rtt_variance)
+            self.rtt += RTT_GAIN * (rtt - self.rtt)
+        self.backoff = 1
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, timeout=None):
+        timeout = timeout or self.timeout
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), timeout)
+        self.seqno = 1
+        self.local_key = self.real_local_key
+        self.last_status_time = 0  # the bulb may have been changed (or power cycled) while we were away
+        if self.version >= 3.4:
+            await asyncio.wait_for(self.negotiate_session_key(), timeout)
+
+    async def close(self):
+        writer = self.writer
+        self.reader = self.writer = None
+        self.last_status_time = 0  # the bulb may change while we are away, e.g. when it is power cycled
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    # Public commands
+
+    async def status(self):
+        if self.version >= 3.4:
+            return await self.request(tinytuya.DP_QUERY_NEW, {})
+        return await self.request(tinytuya.DP_QUERY, {"gwId": self.dev_id, "devId": self.dev_id,
+                                                      "uid": self.dev_id, "t": str(int(time()))})
+
+    async def set_values(self, dps, nowait=False):
+        dps = {str(dp): value for dp, value in dps.items()}
+        if self.version >= 3.4:
+            result = await self.request(tinytuya.CONTROL_NEW,
+                                        {"protocol": 5, "t": int(time()), "data": {"dps": dps}}, nowait)
+        else:
+            result = await self.request(tinytuya.CONTROL, {"devId": self.dev_id, "uid": self.dev_id,
+                                                           "t": str(int(time())), "dps": dps}, nowait)
+        if not nowait and not (isinstance(result, dict) and 'Err' in result):
+            self.last_status.update(dps)
+            self.last_status_time = time()
+        return result
+
+    async def heartbeat(self, nowait=True):
+        return await self.request(tinytuya.HEART_BEAT, {"gwId": self.dev_id, "devId": self.dev_id}, nowait)
+
+    async def request(self, command, json_data, nowait=False):
+        payload = json.dumps(json_data, separators=(',', ':')).encode('utf-8')
+        timeout, retry_limit = request_limits.get()
+        async with self.lock:
+            error = tinytuya.ERR_CONNECT
+            for attempt in range(max(retry_limit or self.retry_limit, 1)):
+                if attempt:
+                    self.retries += 1
+                # worked out for each attempt, as a timeout makes the next attempt wait longer
+                attempt_timeout = timeout or self.reply_timeout
+                try:
+                    if not self.connected:
+                        await self.connect(attempt_timeout)
+                    start = perf_counter()
+                    seqno = await self.send_message(command, payload)
+                    if nowait:
+                        return None
+                    result = await asyncio.wait_for(self.receive_reply(command, seqno), attempt_timeout)
+                    self.observe_rtt(perf_counter() - start)
+                    if isinstance(result, dict) and 'Err' in result:
+                        self.last_status_time = 0  # the bulb did not take the request as we expected
+                    return result
+                except asyncio.TimeoutError:
+                    error = tinytuya.ERR_TIMEOUT
+                    self.timeouts += 1
+                    self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                except (OSError, asyncio.IncompleteReadError, DecodeError):
+                    error = tinytuya.ERR_CONNECT
+                # drop the socket (and stop trusting the shadow state), so the next attempt
+                # reconnects and renegotiates the session
+                await self.close()
+                self.reconnects += 1
+            return error_json(error)
+
+    # Framing and encryption
+
+    async def send_message(self, command, payload):
+        seqno = self.seqno
+        self.writer.write(self.encode_message(MessagePayload(command, payload)))
+        await self.writer.drain()
+        return seqno
+
+    def encode_message(self, msg):
+        hmac_key = None
+        payload = msg.payload
+        cipher = AESCipher(self.local_key)
+
+        if self.version >= 3.4:
+            hmac_key = self.local_key
+            if msg.cmd not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+            if self.version >= 3.5:
+                # 3.5 uses AES-GCM, and the 6699 frame carries the IV and tag
+                message = TuyaMessage(self.seqno, msg.cmd, None, payload, 0, True, tinytuya.PREFIX_6699_VALUE, True)
+                self.seqno += 1
+                return pack_message(message, hmac_key=self.local_key)
+            payload = cipher.encrypt(payload, False)
+        elif self.version >= 3.2:
+            payload = cipher.encrypt(payload, False)
+            if msg.cmd not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+        elif msg.cmd == tinytuya.CONTROL:
+            # 3.1 only encrypts control messages, signed with an md5 of the payload
+            payload = cipher.encrypt(payload)
+            pre_md5 = b"data=" + payload + b"||lpv=" + tinytuya.PROTOCOL_VERSION_BYTES_31 + b"||" + self.local_key
+            payload = (tinytuya.PROTOCOL_VERSION_BYTES_31 + md5(pre_md5).hexdigest()[8:][:16].encode('latin1')
+                       + payload)
+
+        message = TuyaMessage(self.seqno, msg.cmd, 0, payload, 0, True, tinytuya.PREFIX_55AA_VALUE, False)
+        self.seqno += 1
+        return pack_message(message, hmac_key=hmac_key)
+
+    async def read_message(self):
+        # skip anything before the next frame prefix
+        data = await self.reader.readexactly(4)
+        try:
+            while data != tinytuya.PREFIX_55AA_BIN and data != tinytuya.PREFIX_6699_BIN:
+                data = data[1:] + await self.reader.readexactly(1)
+
+            header_len = HEADER_LEN_6699 if data == tinytuya.PREFIX_6699_BIN else HEADER_LEN_55AA
+            data += await self.reader.readexactly(header_len - len(data))
+            header = parse_header(data)
+            data += await self.reader.readexactly(header.total_length - len(data))
+        except asyncio.CancelledError:
+            # a scene was stopped half way through a frame, so the stream is out of step
+            self.writer.close()
+            self.reader = self.writer = None
+            self.last_status_time = 0
+            raise
+
+        hmac_key = self.local_key if self.version >= 3.4 else None
+        msg = unpack_message(data, header=header, hmac_key=hmac_key, no_retcode=False)
+        if not msg.crc_good:
+            raise DecodeError('CRC/HMAC check failed')
+        return msg
+
+    def decode_payload(self, payload):
+        cipher = AESCipher(self.local_key)
+        try:
+            if self.version == 3.4:
+                # 3.4 encrypts the version header along with the payload
+                payload = cipher.decrypt(payload, False, decode_text=False)
+
+            if payload.startswith(tinytuya.PROTOCOL_VERSION_BYTES_31):
+                # 3.1 header, followed by 16 bytes of md5
+                payload = cipher.decrypt(payload[len(tinytuya.PROTOCOL_VERSION_BYTES_31) + 16:], decode_text=False)
+            elif self.version >= 3.2:
+                if payload.startswith(self.version_bytes):
+                    payload = payload[len(self.version_header):]
+                if self.version < 3.4:
+                    payload = cipher.decrypt(payload, False, decode_text=False)
+        except ValueError:
+            return error_json(tinytuya.ERR_PAYLOAD, payload)
+
+        try:
+            result = json.loads(payload)
+        except ValueError:
+            return error_json(tinytuya.ERR_JSON, payload)
+
+        # 3.4+ puts the data points in {"data": {"dps": {...}}}
+        if 'dps' not in result and isinstance(result.get('data'), dict) and 'dps' in result['data']:
+            result['dps'] = result['data']['dps']
+        return result
+
+    async def receive_reply(self, command, seqno):
+        while True:
+            msg = await self.read_message()
+            result = self.decode_payload(msg.payload) if msg.payload else None
+
+            if result and isinstance(result.get('dps'), dict):
+                self.last_status.update(result['dps'])
+                self.last_status_time = time()
+
+            # bulbs before 3.5 echo our sequence number, 3.5 bulbs use their own counter
+            if msg.cmd == command and (self.version >= 3.5 or msg.seqno == seqno):
+                if command in (tinytuya.DP_QUERY, tinytuya.DP_QUERY_NEW) and not result:
+                    continue  # an ack, the data points follow
+                return result if result else {}
+            # anything else is an update pushed by the bulb, or a late reply to an earlier
+            # command, so keep reading
+
+    # Session key negotiation (3.4 and 3.5)
+
+    async def negotiate_session_key(self):
+        local_nonce = os.urandom(16)
+        await self.send_message(tinytuya.SESS_KEY_NEG_START, local_nonce)
+
+        msg = await self.read_message()
+        if msg.cmd != tinytuya.SESS_KEY_NEG_RESP:
+            raise DecodeError('unexpected reply to session key negotiation: {}'.format(msg.cmd))
+
+        payload = msg.payload
+        if self.version == 3.4:
+            payload = AESCipher(self.real_local_key).decrypt(payload, False, decode_text=False)
+        if len(payload) < 48:
+            raise DecodeError('session key negotiation reply is too short')
+
+        remote_nonce = payload[:16]
+        if hmac.new(self.real_local_key, local_nonce, sha256).digest() != payload[16:48]:
+            raise DecodeError('session key negotiation failed the HMAC check')
+
+        await self.send_message(tinytuya.SESS_KEY_NEG_FINISH,
+                                hmac.new(self.real_local_key, remote_nonce, sha256).digest())
+
+        session_key = bytes([a ^ b for (a, b) in zip(local_nonce, remote_nonce)])
+        cipher = AESCipher(self.real_local_key)
+        if self.version == 3.4:
+            self.local_key = cipher.encrypt(session_key, False, pad=False)
+        else:
+            self.local_key = cipher.encrypt(session_key, use_base64=False, pad=False, iv=local_nonce[:12])[12:28]
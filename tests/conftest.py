@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# the app imports Colours (and app.*) from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.models import bulb as bulb_models  # noqa: E402
+from app.services.connection_service import connections  # noqa: E402
+from app.services.scene_service import SceneClock, current_clock  # noqa: E402
+
+BULB_NAMES = ["Den Light", "White Lamp", "Black Lamp", "Sofa Light"]
+
+
+# Bulbs in the registry, which are never contacted (see sent_commands)
+@pytest.fixture
+def fake_bulbs():
+    added = []
+    for i, name in enumerate(BULB_NAMES):
+        added.append(bulb_models.new_bulb({"name": name, "id": "bulb{}".format(i), "ip": "127.0.0.1",
+                                           "key": "0123456789abcdef", "ver": "3.3"}))
+        bulb_models.registry.add(added[-1])
+    bulb_models.set_up_defaults()
+    yield {this_bulb.name: this_bulb for this_bulb in added}
+    for this_bulb in added:
+        bulb_models.registry.remove(this_bulb)
+    bulb_models.set_up_defaults()
+
+
+# Records every command sent to a bulb as (bulb name, command, args), instead of sending it
+@pytest.fixture
+def sent_commands(monkeypatch):
+    sent = []
+
+    async def send(this_bulb, command, *args, **kwargs):
+        sent.append((this_bulb.name, command, args))
+        await asyncio.sleep(0)
+        return {}
+
+    monkeypatch.setattr(connections, "send", send)
+    return sent
+
+
+# Runs a scene with a clock that stops it after the given number of ticks
+@pytest.fixture
+def run_scene():
+    def run_scene(scene, ticks, bulbs=None):
+        clock = SceneClock("test_scene", bulbs)
+        ticked = []
+
+        async def tick(period):
+            ticked.append(period)
+            if len(ticked) >= ticks:
+                clock.stop()
+                return False
+            await asyncio.sleep(0)
+            return True
+
+        clock.tick = tick
+
+        async def run():
+            token = current_clock.set(clock)
+            try:
+                await scene
+            finally:
+                current_clock.reset(token)
+
+        asyncio.run(run())
+        return clock
+
+    return run_scene
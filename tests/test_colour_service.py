@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from app.services import colour_service
+from app.services.colour_service import final_colours, final_colours_batch, get_final_colours
+
+MULTIPLIERS = (0.01, 0.2, 0.5, 0.99, 1, 1.01, 1.5, 2, 5, 300)
+
+
+# get_final_colours as it was before the cache and the batch path, which fails on black
+def baseline_final_colours(red, green, blue, init_mul):
+    init_cols = [red, green, blue]
+    if init_mul > 1:
+        mul = min(init_mul, round(256 / max(init_cols), 2))
+        return [int(min(col * mul, 255)) for col in init_cols]
+    elif init_mul < 1:
+        mul = max(init_mul, round(1 / min(col for col in init_cols if col != 0), 2))
+        return [int(col * mul) for col in init_cols]
+    return init_cols
+
+
+def random_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        colour = [rng.choice((0, 1, 2, 127, 128, 254, 255, rng.randint(0, 255))) for _ in range(3)]
+        rows.append((*colour, rng.choice(MULTIPLIERS + (round(rng.uniform(0, 3), 2),))))
+    return rows
+
+
+def test_scalar_matches_baseline():
+    for red, green, blue, mul in random_rows(5000):
+        if (red, green, blue) == (0, 0, 0):
+            continue
+        expected = baseline_final_colours(red, green, blue, mul)
+        assert get_final_colours(red, green, blue, mul) == expected
+        assert list(final_colours.__wrapped__(red, green, blue, mul)) == expected
+
+
+def test_batch_matches_scalar():
+    rows = random_rows(20000, seed=1)
+    assert final_colours_batch(rows) == [get_final_colours(*row) for row in rows]
+
+
+@pytest.mark.parametrize("mul", MULTIPLIERS)
+def test_black_stays_black(mul):
+    assert get_final_colours(0, 0, 0, mul) == [0, 0, 0]
+    assert final_colours_batch([(0, 0, 0, mul)]) == [[0, 0, 0]]
+
+
+@pytest.mark.parametrize("mul", MULTIPLIERS)
+def test_zero_channels_stay_zero(mul):
+    rows = [(0, 0, 200, mul), (0, 50, 0, mul), (3, 0, 0, mul), (0, 1, 255, mul)]
+    results = final_colours_batch(rows)
+    assert results == [get_final_colours(*row) for row in rows]
+    for row, result in zip(rows, results):
+        assert [col for col, init in zip(result, row[:3]) if init == 0] == [0] * row[:3].count(0)
+
+
+def test_batch_handles_values_outside_the_tables():
+    rows = [(300, 10, 0, 0.5), (-5, 10, 20, 2), (10.5, 20, 30, 1.5)]
+    assert final_colours_batch(rows) == [[int(col) for col in get_final_colours(*row)] for row in rows]
+
+
+def test_batch_without_numpy(monkeypatch):
+    rows = random_rows(500, seed=2)
+    expected = final_colours_batch(rows)
+    monkeypatch.setattr(colour_service, "np", None)
+    assert final_colours_batch(rows) == expected
+
+
+def test_empty_batch():
+    assert final_colours_batch([]) == []
@@ -0,0 +1,46 @@
+import asyncio
+from time import perf_counter
+
+from fastapi import Response
+from tinytuya import ERR_TIMEOUT, error_json
+
+from app.models.bulb import RgbClass
+from app.routers.bulb_controller import get_command_status, set_bulb_colour
+from app.services.command_service import command_tracker
+from app.services.connection_service import connections
+
+DEADLINE = 0.1
+
+
+def test_deadline_returns_each_bulbs_status(fake_bulbs, monkeypatch):
+    slow_bulb_gives_up = asyncio.Event()
+
+    async def send(this_bulb, command, *args, **kwargs):
+        if this_bulb.name == "White Lamp":
+            await slow_bulb_gives_up.wait()  # until its client times out
+            return error_json(ERR_TIMEOUT, "Timed out")
+        return {}
+
+    monkeypatch.setattr(connections, "send", send)
+    rgb = RgbClass(red=255, green=0, blue=0, deadline=DEADLINE,
+                   toggles=[{"name": "Den Light", "bright_mul": 1.0}, {"name": "White Lamp", "bright_mul": 1.0}])
+
+    async def run():
+        start = perf_counter()
+        answer = await set_bulb_colour(rgb, Response())
+        waited = perf_counter() - start
+        pending = dict(await get_command_status(answer["command_id"]))
+        slow_bulb_gives_up.set()
+        await asyncio.gather(*command_tracker.tasks)
+        return answer, waited, pending, await get_command_status(answer["command_id"])
+
+    answer, waited, pending, finished = asyncio.run(run())
+    assert DEADLINE <= waited < DEADLINE + 0.5
+    assert answer["status"] == "pending" and answer["deadline"] == DEADLINE
+    assert answer["bulbs"]["Den Light"]["status"] == "ok"
+    assert answer["bulbs"]["White Lamp"]["status"] == "timeout"
+    assert pending["status"] == "pending"
+    assert finished["status"] == "done"
+    assert finished["bulbs"]["Den Light"]["status"] == "ok"
+    assert finished["bulbs"]["White Lamp"]["status"] == "timeout"
+    assert finished["bulbs"]["White Lamp"]["error"]["Err"] == str(ERR_TIMEOUT)
@@ -0,0 +1,139 @@
+import asyncio
+from time import time
+
+from app.services.connection_service import SHADOW_MAX_AGE, BulbConnection, Unchanged
+
+TIMEOUT = 1  # a waiter that is never answered fails the test instead of hanging it
+
+
+# A connection whose commands are recorded instead of sent. Each command waits for the test
+# to let it finish, so more can be queued while it is "in flight"
+class StubbedConnection:
+    def __init__(self, this_bulb):
+        self.connection = BulbConnection(this_bulb)
+        self.connection.run = self.run
+        self.ran = []
+        self.started = asyncio.Event()
+        self.gate = asyncio.Event()
+
+    async def run(self, command, *args, **kwargs):
+        self.ran.append((command, args))
+        self.started.set()
+        await self.gate.wait()
+        return {"command": command, "args": list(args)}
+
+    # Sends the first command, and waits until it is in flight
+    async def start(self, command, *args):
+        task = asyncio.create_task(self.connection.send(command, *args))
+        await self.started.wait()
+        return task
+
+
+# Queues the commands behind the one in flight
+async def queue(stub, *commands):
+    tasks = [asyncio.create_task(stub.connection.send(command, *args)) for command, *args in commands]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_superseded_command_gets_the_newer_result(fake_bulbs):
+    async def run():
+        stub = StubbedConnection(fake_bulbs["Den Light"])
+        first = await stub.start("set_colour", 1, 1, 1)
+        older, newer = await queue(stub, ("set_colour", 2, 2, 2), ("set_colour", 3, 3, 3))
+        stub.gate.set()
+        return stub.ran, await first, await older, await newer, stub.connection.coalesced
+
+    ran, first, older, newer, coalesced = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert ran == [("set_colour", (1, 1, 1)), ("set_colour", (3, 3, 3))]
+    assert first == {"command": "set_colour", "args": [1, 1, 1]}
+    assert older == newer == {"command": "set_colour", "args": [3, 3, 3]}
+    assert coalesced == 1
+
+
+def test_requeued_kind_is_sent_after_the_others(fake_bulbs):
+    async def run():
+        stub = StubbedConnection(fake_bulbs["Den Light"])
+        first = await stub.start("turn_on")
+        queued = await queue(stub, ("set_colour", 2, 2, 2), ("set_brightness", 50), ("set_colour", 3, 3, 3))
+        stub.gate.set()
+        await asyncio.gather(first, *queued)
+        return stub.ran
+
+    assert asyncio.run(asyncio.wait_for(run(), TIMEOUT)) == [("turn_on", ()), ("set_brightness", (50,)), ("set_colour", (3, 3, 3))]
+
+
+def test_cancelled_caller_leaves_the_other_waiters(fake_bulbs):
+    async def run():
+        stub = StubbedConnection(fake_bulbs["Den Light"])
+        first = await stub.start("set_colour", 1, 1, 1)
+        cancelled, waiting = await queue(stub, ("set_colour", 2, 2, 2), ("set_colour", 3, 3, 3))
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        stub.gate.set()
+        return stub.ran, await first, await waiting, cancelled.cancelled()
+
+    ran, first, waiting, was_cancelled = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert ran == [("set_colour", (1, 1, 1)), ("set_colour", (3, 3, 3))]
+    assert waiting == {"command": "set_colour", "args": [3, 3, 3]}
+    assert was_cancelled
+
+
+def test_cancelled_caller_of_the_command_being_sent(fake_bulbs):
+    async def run():
+        stub = StubbedConnection(fake_bulbs["Den Light"])
+        cancelled = await stub.start("set_colour", 1, 1, 1)
+        waiting, = await queue(stub, ("set_brightness", 50))
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        stub.gate.set()
+        return stub.ran, await waiting
+
+    ran, waiting = asyncio.run(asyncio.wait_for(run(), TIMEOUT))
+    assert ran == [("set_colour", (1, 1, 1)), ("set_brightness", (50,))]
+    assert waiting == {"command": "set_brightness", "args": [50]}
+
+
+# Stands in for the TuyaClient behind write(), with a shadow state of the bulb's values
+class StubClient:
+    def __init__(self, last_status, age=0, connected=True):
+        self.last_status = last_status
+        self.last_status_time = time() - age
+        self.connected = connected
+        self.written = []
+
+    async def set_values(self, dps, nowait=False):
+        self.written.append(dps)
+        return {"dps": dps}
+
+
+def write(this_bulb, client, dps):
+    connection = BulbConnection(this_bulb)
+    connection.client = client
+    result = asyncio.run(connection.write(dps))
+    return result, connection.unchanged
+
+
+def test_write_skips_values_the_bulb_has(fake_bulbs):
+    client = StubClient({"20": True, "21": "colour", "22": 500})
+    result, unchanged = write(fake_bulbs["Den Light"], client, {"20": True, "21": "colour"})
+    assert isinstance(result, Unchanged) and result == {}
+    assert unchanged == 1 and client.written == []
+
+
+def test_write_sends_only_the_changed_values(fake_bulbs):
+    client = StubClient({"20": True, "21": "colour", "22": 500})
+    write(fake_bulbs["Den Light"], client, {"20": True, "21": "white", "22": 500})
+    assert client.written == [{"21": "white"}]
+
+
+def test_write_sends_everything_after_a_reconnect(fake_bulbs):
+    client = StubClient({"20": True, "21": "colour"}, connected=False)
+    result, unchanged = write(fake_bulbs["Den Light"], client, {"20": True, "21": "colour"})
+    assert client.written == [{"20": True, "21": "colour"}] and unchanged == 0
+
+
+def test_write_sends_everything_once_the_shadow_is_old(fake_bulbs):
+    client = StubClient({"20": True, "21": "colour"}, age=SHADOW_MAX_AGE + 1)
+    write(fake_bulbs["Den Light"], client, {"20": True, "21": "colour"})
+    assert client.written == [{"20": True, "21": "colour"}]
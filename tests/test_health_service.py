@@ -0,0 +1,35 @@
+import asyncio
+
+from tinytuya import ERR_TIMEOUT, error_json
+
+from app.services.connection_service import BulbConnection, Unchanged, connections
+from app.services.health_service import FAILURE_THRESHOLD, health
+
+
+def send_results(monkeypatch, this_bulb, results):
+    async def send(connection, command, *args, **kwargs):
+        return results.pop(0)
+
+    monkeypatch.setattr(BulbConnection, "send", send)
+    sent = [asyncio.run(connections.send(this_bulb, "set_colour", 1, 1, 1)) for i in range(len(results))]
+    connections.connections.pop(this_bulb.name)
+    return sent
+
+
+def test_offline_after_failures(fake_bulbs, monkeypatch):
+    this_bulb = fake_bulbs["Den Light"]
+    timeout = error_json(ERR_TIMEOUT, "Timed out")
+    send_results(monkeypatch, this_bulb, [dict(timeout) for i in range(FAILURE_THRESHOLD)])
+    assert health.is_offline(this_bulb.name)
+    health.forget(this_bulb.name)
+
+
+def test_unchanged_writes_are_not_answers(fake_bulbs, monkeypatch):
+    this_bulb = fake_bulbs["Den Light"]
+    timeout = error_json(ERR_TIMEOUT, "Timed out")
+    results = send_results(monkeypatch, this_bulb, [dict(timeout), Unchanged(), dict(timeout), Unchanged(),
+                                                    dict(timeout)])
+    assert results[1] == {}
+    # the writes skipped in between did not reset the count of failures
+    assert health.is_offline(this_bulb.name)
+    health.forget(this_bulb.name)
@@ -0,0 +1,29 @@
+from app.models.bulb import LightningSceneClass
+from app.services.bulb_service import lightning_scene_async
+from app.services.connection_service import connections
+from app.services.scene_service import scene_clock
+
+
+def test_lightning_defaults_strike(fake_bulbs, sent_commands, run_scene):
+    # the default lightning colour is an RgbColour, as lightning_flash_alt expects
+    lightning_class = LightningSceneClass(lightning_percent_chance=100, lightning_length=0, wait_time_range=[1, 2],
+                                          toggles=[{"name": "Den Light"}, {"name": "White Lamp"}])
+    run_scene(lightning_scene_async(lightning_class), ticks=1)
+    assert ("Den Light", "set_colour", (255, 255, 255)) in sent_commands
+    assert ("White Lamp", "set_colour", (255, 255, 255)) in sent_commands
+
+
+def test_lightning_skips_a_bulb_taken_during_the_strike(fake_bulbs, monkeypatch, run_scene):
+    sent = []
+
+    async def send(this_bulb, command, *args, **kwargs):
+        sent.append(this_bulb.name)
+        scene_clock().bulbs.pop(fake_bulbs["White Lamp"].dev_id, None)  # taken while the flashes were going out
+        return {}
+
+    monkeypatch.setattr(connections, "send", send)
+    lightning_class = LightningSceneClass(lightning_percent_chance=100, lightning_length=0, wait_time_range=[1, 2],
+                                          toggles=[{"name": "Den Light"}, {"name": "White Lamp", "delay": 0.01}])
+    run_scene(lightning_scene_async(lightning_class), ticks=1,
+              bulbs=[fake_bulbs["Den Light"], fake_bulbs["White Lamp"]])
+    assert sent == ["Den Light", "Den Light"]
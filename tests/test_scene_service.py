@@ -0,0 +1,59 @@
+import asyncio
+
+from app.services.scene_service import SceneManager
+
+
+async def forever():
+    await asyncio.Event().wait()
+
+
+def test_overlapping_starts_leave_one_scene(fake_bulbs):
+    den = fake_bulbs["Den Light"]
+
+    async def run():
+        manager = SceneManager()
+        await manager.start("old", forever(), [den])
+        # both starts wait for "old" to stop before taking the bulb
+        first, second = await asyncio.gather(manager.start("a", forever(), [den]),
+                                             manager.start("b", forever(), [den]))
+        running = manager.running()
+        owner = manager.owners[den.dev_id]
+        await manager.release([den])
+        return first, second, running, owner, manager.running()
+
+    first, second, running, owner, after_release = asyncio.run(run())
+    assert running == [second] and owner == second
+    assert after_release == []
+
+
+def test_scene_keeps_a_renamed_bulb(fake_bulbs):
+    den = fake_bulbs["Den Light"]
+
+    async def run():
+        manager = SceneManager()
+        scene_id = await manager.start("scene", forever(), [den, fake_bulbs["White Lamp"]])
+        den.name = "Den Lamp"  # as a snapshot reload does, keeping the bulb's id
+        clock = manager.clocks[scene_id]
+        owned = clock.owns(den)
+        described = manager.describe()
+        await manager.release([den])
+        left = manager.describe()
+        await manager.stop_all()
+        return owned, described, left
+
+    try:
+        owned, described, left = asyncio.run(run())
+    finally:
+        den.name = "Den Light"
+    assert owned
+    assert described[0]["bulbs"] == ["Den Lamp", "White Lamp"]
+    assert left[0]["bulbs"] == ["White Lamp"]
+
+
+def test_scene_without_bulbs_is_not_started():
+    async def run():
+        manager = SceneManager()
+        scene_id = await manager.start("scene", forever(), [])
+        return scene_id, manager.running()
+
+    assert asyncio.run(run()) == (None, [])
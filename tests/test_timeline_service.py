@@ -0,0 +1,96 @@
+import Colours
+from app.models.bulb import MultiColourSceneClass, RandomColourSceneClass, RgbColour
+from app.services.colour_service import get_final_colours
+from app.services.connection_service import connections
+from app.services.scene_service import scene_clock
+from app.services.timeline_service import compile_multi_colour, compile_random_colour, compile_xmas, play
+
+
+def colours(sent):
+    return [(name, args) for name, command, args in sent]
+
+
+def test_compile_xmas(fake_bulbs):
+    timeline = compile_xmas(3)
+    assert timeline.tick == 3
+    first, second = [{frame.bulb.name: frame.colours for frame in step.frames} for step in timeline.steps]
+    assert first == {"Den Light": ((255, 0, 0),), "White Lamp": ((0, 100, 0),), "Black Lamp": ((0, 100, 0),),
+                     "Sofa Light": ((255, 0, 0),)}
+    assert second["Den Light"] == ((0, 255, 0),) and second["White Lamp"] == ((100, 0, 0),)
+
+
+def test_compile_multi_colour_offsets_each_list(fake_bulbs):
+    multi_class = MultiColourSceneClass(wait_time=2, colour_list=[Colours.RED, Colours.BLUE, Colours.GREEN],
+                                        bulb_lists=[[{"name": "Den Light", "bright_mul": 2.0}],
+                                                    [{"name": "White Lamp"}]])
+    timeline = compile_multi_colour(multi_class)
+    assert len(timeline.steps) == 3
+    red, blue, green = (255, 0, 0), (0, 0, 255), (0, 255, 0)
+    expected = [(red, blue), (blue, green), (green, red)]
+    for step, (den, white) in zip(timeline.steps, expected):
+        assert [frame.colours for frame in step.frames] == [(tuple(get_final_colours(*den, 2.0)),), (white,)]
+
+
+def test_compile_multi_colour_pads_with_white(fake_bulbs):
+    multi_class = MultiColourSceneClass(colour_list=[Colours.RED],
+                                        bulb_lists=[[{"name": "Den Light"}], [{"name": "White Lamp"}]])
+    steps = compile_multi_colour(multi_class).steps
+    assert [frame.colours for frame in steps[0].frames] == [((255, 0, 0),), ((255, 255, 255),)]
+
+
+def test_compile_defaults(fake_bulbs):
+    # the default colour lists are RgbColour models rather than dicts
+    assert compile_random_colour(RandomColourSceneClass()).steps
+    assert compile_multi_colour(MultiColourSceneClass()).steps
+
+
+def test_compile_random_colour(fake_bulbs):
+    random_class = RandomColourSceneClass(colour_list=[RgbColour(**Colours.RED), Colours.BLUE],
+                                          toggles=[{"name": "Black Lamp", "bright_mul": 0.5}])
+    (step,) = compile_random_colour(random_class).steps
+    (frame,) = step.frames
+    assert frame.bulb.name == "Black Lamp"
+    assert frame.colours == (tuple(get_final_colours(255, 0, 0, 0.5)), tuple(get_final_colours(0, 0, 255, 0.5)))
+
+
+def test_compile_random_colour_without_colours(fake_bulbs):
+    assert compile_random_colour(RandomColourSceneClass(colour_list=[])).steps == ()
+
+
+def test_play_loops_through_the_steps(fake_bulbs, sent_commands, run_scene):
+    multi_class = MultiColourSceneClass(colour_list=[Colours.RED, Colours.BLUE],
+                                        bulb_lists=[[{"name": "Den Light"}], [{"name": "White Lamp"}]])
+    run_scene(play(compile_multi_colour(multi_class), parallel=False), ticks=3)
+    red, blue = (255, 0, 0), (0, 0, 255)
+    assert colours(sent_commands) == [("Den Light", red), ("White Lamp", blue), ("Den Light", blue),
+                                      ("White Lamp", red), ("Den Light", red), ("White Lamp", blue)]
+    assert {command for name, command, args in sent_commands} == {"set_colour"}
+
+
+def test_play_parallel_sends_every_bulb(fake_bulbs, sent_commands, run_scene):
+    run_scene(play(compile_xmas(1), parallel=True), ticks=1)
+    assert sorted(name for name, args in colours(sent_commands)) == sorted(fake_bulbs)
+
+
+def test_play_skips_bulbs_the_scene_does_not_own(fake_bulbs, sent_commands, run_scene):
+    run_scene(play(compile_xmas(1), parallel=False), ticks=2, bulbs=[fake_bulbs["Den Light"]])
+    assert [name for name, args in colours(sent_commands)] == ["Den Light", "Den Light"]
+
+
+def test_play_empty_timeline(fake_bulbs, sent_commands, run_scene):
+    run_scene(play(compile_random_colour(RandomColourSceneClass(colour_list=[]))), ticks=1)
+    assert sent_commands == []
+
+
+def test_play_skips_a_bulb_taken_during_the_step(fake_bulbs, monkeypatch, run_scene):
+    sent = []
+
+    async def send(this_bulb, command, *args, **kwargs):
+        sent.append(this_bulb.name)
+        # taken, e.g. by a /set_colour that arrived while this bulb was being sent
+        scene_clock().bulbs.pop(fake_bulbs["Sofa Light"].dev_id, None)
+        return {}
+
+    monkeypatch.setattr(connections, "send", send)
+    run_scene(play(compile_xmas(1), parallel=False), ticks=1, bulbs=list(fake_bulbs.values()))
+    assert sent == ["Den Light", "White Lamp", "Black Lamp"]
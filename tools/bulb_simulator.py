@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+
+# *************************************************************************
+# Fake Tuya bulbs, for testing and benchmarking the API without real bulbs
+# Serves a number of bulbs on localhost that speak the Tuya local protocol
+#   (3.1 - 3.5), and writes a snapshot file that points the API at them
+# Each bulb can be given a latency, a packet loss rate, and can drop
+#   commands that arrive while it is still busy, like the real ones do
+#
+# python3 tools/bulb_simulator.py --bulbs 6 --versions 3.3,3.4,3.5 --latency 0.05
+# TUYA_SNAPSHOT=simulator_snapshot.json uvicorn TuyaBulbAPI:app
+# *************************************************************************
+
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import random
+import secrets
+import struct
+import sys
+from hashlib import sha256
+
+import tinytuya
+from tinytuya import AESCipher, TuyaMessage, pack_message, parse_header, unpack_message
+
+HEADER_LEN_55AA = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_55AA)
+HEADER_LEN_6699 = struct.calcsize(tinytuya.MESSAGE_HEADER_FMT_6699)
+
+# a type B RGB bulb, switched on in white mode
+DEFAULT_DPS = {'20': True, '21': 'white', '22': 1000, '23': 0, '24': '000003e803e8',
+               '25': '000e0d0000000000000000c803e8', '26': 0}
+
+
+class FakeBulb:
+    def __init__(self, name, dev_id, local_key, version, latency=0.0, jitter=0.0, loss=0.0, drop_when_busy=False):
+        self.name = name
+        self.dev_id = dev_id
+        self.local_key = local_key
+        self.version = float(version)
+        self.latency = latency  # seconds before each reply
+        self.jitter = jitter  # up to this much extra latency, picked at random for each reply
+        self.loss = loss  # chance of a request getting no reply at all
+        self.drop_when_busy = drop_when_busy  # ignore requests (and connections) while busy
+        self.dps = dict(DEFAULT_DPS)
+        self.host = None
+        self.port = None
+        self.server = None
+        self.busy_until = 0
+        self.connections = 0
+        self.stats = {"connections": 0, "refused": 0, "received": 0, "lost": 0, "dropped": 0, "replied": 0}
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.host = host
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def snapshot_entry(self):
+        return {"name": self.name, "id": self.dev_id, "ip": self.host, "port": self.port,
+                "key": self.local_key, "ver": str(self.version)}
+
+    async def handle(self, reader, writer):
+        # the real bulbs only talk to one client at a time
+        if self.drop_when_busy and self.connections:
+            self.stats["refused"] += 1
+            writer.close()
+            return
+
+        self.connections += 1
+        self.stats["connections"] += 1
+        try:
+            await BulbSession(self, reader, writer).run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    # Works out when a request will be answered, or returns None if it is lost or dropped
+    def schedule(self, now):
+        self.stats["received"] += 1
+        if random.random() < self.loss:
+            self.stats["lost"] += 1
+            return None
+        if self.drop_when_busy and now < self.busy_until:
+            self.stats["dropped"] += 1
+            return None
+        self.busy_until = max(now, self.busy_until) + self.latency + random.uniform(0, self.jitter)
+        return self.busy_until
+
+
+# One client connection to a fake bulb, with its own session key and sequence numbers
+
+class BulbSession:
+    def __init__(self, bulb: FakeBulb, reader, writer):
+        self.bulb = bulb
+        self.reader = reader
+        self.writer = writer
+        self.version = bulb.version
+        self.version_bytes = str(self.version).encode('latin1')
+        self.version_header = self.version_bytes + tinytuya.PROTOCOL_3x_HEADER
+        self.real_local_key = bulb.local_key.encode('latin1')
+        self.local_key = self.real_local_key
+        self.seqno = 100
+        self.replies = []
+
+    async def run(self):
+        if self.version >= 3.4:
+            await self.negotiate_session_key()
+
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await self.read_message()
+            reply_at = self.bulb.schedule(loop.time())
+            if reply_at is not None:
+                # replies go out in order, after the bulb has finished what it was doing
+                self.replies.append(asyncio.create_task(self.reply(msg, reply_at)))
+                self.replies = [task for task in self.replies if not task.done()]
+
+    async def reply(self, msg, reply_at):
+        await asyncio.sleep(reply_at - asyncio.get_running_loop().time())
+        request = self.decode_payload(msg.payload)
+
+        if msg.cmd in (tinytuya.DP_QUERY, tinytuya.DP_QUERY_NEW):
+            self.send(msg.cmd, {"devId": self.bulb.dev_id, "dps": self.bulb.dps}, msg.seqno)
+        elif msg.cmd in (tinytuya.CONTROL, tinytuya.CONTROL_NEW):
+            dps = request.get('dps') or request.get('data', {}).get('dps', {})
+            # a null value asks for the current value (how 3.2 'device22' bulbs are queried)
+            self.bulb.dps.update({dp: value for dp, value in dps.items() if value is not None})
+            dps = {dp: self.bulb.dps[dp] for dp in dps if dp in self.bulb.dps}
+            # an empty ack, followed by the changed data points
+            self.send_frame(msg.cmd, b'', msg.seqno)
+            self.send(tinytuya.STATUS, {"devId": self.bulb.dev_id, "dps": dps, "t": 0})
+        elif msg.cmd == tinytuya.HEART_BEAT:
+            self.send_frame(msg.cmd, b'', msg.seqno)
+        else:
+            return
+        self.bulb.stats["replied"] += 1
+        await self.writer.drain()
+
+    # Framing and encryption, the device side of app/services/tuya_client.py
+
+    async def read_message(self):
+        data = await self.reader.readexactly(4)
+        while data != tinytuya.PREFIX_55AA_BIN and data != tinytuya.PREFIX_6699_BIN:
+            data = data[1:] + await self.reader.readexactly(1)
+        header_len = HEADER_LEN_6699 if data == tinytuya.PREFIX_6699_BIN else HEADER_LEN_55AA
+        data += await self.reader.readexactly(header_len - len(data))
+        header = parse_header(data)
+        data += await self.reader.readexactly(header.total_length - len(data))
+        hmac_key = self.local_key if self.version >= 3.4 else None
+        # client messages have no return code
+        return unpack_message(data, header=header, hmac_key=hmac_key, no_retcode=True)
+
+    def send_frame(self, command, payload, seqno=None):
+        # bulbs before 3.5 echo the request's sequence number
+        if seqno is None or self.version >= 3.5:
+            self.seqno += 1
+            seqno = self.seqno
+        if self.version >= 3.5:
+            message = TuyaMessage(seqno, command, 0, payload, 0, True, tinytuya.PREFIX_6699_VALUE, True)
+            frame = pack_message(message, hmac_key=self.local_key)
+        else:
+            hmac_key = self.local_key if self.version >= 3.4 else None
+            message = TuyaMessage(seqno, command, 0, struct.pack('>I', 0) + payload, 0, True,
+                                  tinytuya.PREFIX_55AA_VALUE, False)
+            frame = pack_message(message, hmac_key=hmac_key)
+        self.writer.write(frame)
+
+    def send(self, command, json_data, seqno=None):
+        payload = json.dumps(json_data, separators=(',', ':')).encode('utf-8')
+        cipher = AESCipher(self.local_key)
+        if self.version >= 3.4:
+            if command not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+            if self.version < 3.5:
+                payload = cipher.encrypt(payload, False)
+        elif self.version >= 3.2:
+            payload = cipher.encrypt(payload, False)
+            if command not in tinytuya.NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+        self.send_frame(command, payload, seqno)
+
+    def decode_payload(self, payload):
+        if not payload:
+            return {}
+        cipher = AESCipher(self.local_key)
+        if self.version == 3.4:
+            payload = cipher.decrypt(payload, False, decode_text=False)
+        if payload.startswith(tinytuya.PROTOCOL_VERSION_BYTES_31):
+            payload = cipher.decrypt(payload[len(tinytuya.PROTOCOL_VERSION_BYTES_31) + 16:], decode_text=False)
+        elif self.version >= 3.2:
+            if payload.startswith(self.version_bytes):
+                payload = payload[len(self.version_header):]
+            if self.version < 3.4:
+                payload = cipher.decrypt(payload, False, decode_text=False)
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return {}
+
+    async def negotiate_session_key(self):
+        msg = await self.read_message()
+        local_nonce = msg.payload
+        if self.version == 3.4:
+            local_nonce = AESCipher(self.real_local_key).decrypt(local_nonce, False, decode_text=False)
+
+        remote_nonce = os.urandom(16)
+        payload = remote_nonce + hmac.new(self.real_local_key, local_nonce, sha256).digest()
+        if self.version == 3.4:
+            payload = AESCipher(self.real_local_key).encrypt(payload, False)
+        self.send_frame(tinytuya.SESS_KEY_NEG_RESP, payload)
+        await self.writer.drain()
+
+        await self.read_message()  # SESS_KEY_NEG_FINISH
+        session_key = bytes([a ^ b for (a, b) in zip(local_nonce, remote_nonce)])
+        cipher = AESCipher(self.real_local_key)
+        if self.version == 3.4:
+            self.local_key = cipher.encrypt(session_key, False, pad=False)
+        else:
+            self.local_key = cipher.encrypt(session_key, use_base64=False, pad=False, iv=local_nonce[:12])[12:28]
+
+
+# Setting up the bulbs
+
+def new_bulb_configs(count, versions):
+    return [{"name": "Sim Bulb {}".format(i + 1),
+             "id": "bf" + secrets.token_hex(10),
+             "key": secrets.token_hex(8),
+             "ver": versions[i % len(versions)]} for i in range(count)]
+
+
+def snapshot_bulb_configs(path):
+    with open(path, 'r') as infile:
+        return json.load(infile)['devices']
+
+
+async def start_bulbs(configs, host="127.0.0.1", base_port=0, **behaviour):
+    fake_bulbs = []
+    for i, config in enumerate(configs):
+        options = dict(behaviour)
+        options.update({key: config[key] for key in ("latency", "jitter", "loss", "drop_when_busy") if key in config})
+        fake_bulb = FakeBulb(config['name'], config['id'], config['key'], config['ver'], **options)
+        fake_bulbs.append(await fake_bulb.start(host, base_port + i if base_port else 0))
+    return fake_bulbs
+
+
+def write_snapshot(fake_bulbs, path):
+    with open(path, 'w') as outfile:
+        json.dump({"timestamp": 0, "devices": [fake_bulb.snapshot_entry() for fake_bulb in fake_bulbs]},
+                  outfile, indent=1)
+
+
+def print_stats(fake_bulbs):
+    for fake_bulb in fake_bulbs:
+        print("{} ({}) : {}".format(fake_bulb.name, fake_bulb.version, fake_bulb.stats))
+
+
+async def run(args):
+    if args.from_snapshot:
+        configs = snapshot_bulb_configs(args.from_snapshot)
+    else:
+        configs = new_bulb_configs(args.bulbs, args.versions.split(','))
+
+    # per bulb overrides, e.g. {"Sim Bulb 2": {"latency": 0.5, "drop_when_busy": true}}
+    if args.config:
+        with open(args.config, 'r') as infile:
+            overrides = json.load(infile)
+        for config in configs:
+            config.update(overrides.get(config['name'], {}))
+
+    fake_bulbs = await start_bulbs(configs, args.host, args.base_port, latency=args.latency, jitter=args.jitter,
+                                   loss=args.loss, drop_when_busy=args.drop_when_busy)
+    write_snapshot(fake_bulbs, args.snapshot)
+
+    for fake_bulb in fake_bulbs:
+        print("{} ({}) listening on {}:{}".format(fake_bulb.name, fake_bulb.version, fake_bulb.host, fake_bulb.port))
+    print("Snapshot written to {}".format(args.snapshot))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print_stats(fake_bulbs)
+        for fake_bulb in fake_bulbs:
+            await fake_bulb.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves fake Tuya bulbs on localhost")
+    parser.add_argument("--bulbs", type=int, default=6, help="number of bulbs to serve")
+    parser.add_argument("--versions", default="3.3", help="protocol versions, given to the bulbs in turn")
+    parser.add_argument("--from-snapshot", help="serve the bulbs of this snapshot (names, ids, keys and versions)")
+    parser.add_argument("--snapshot", default="simulator_snapshot.json", help="snapshot file to write")
+    parser.add_argument("--config", help="json file of per bulb latency, jitter, loss and drop_when_busy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=0, help="first port to use (default: any free port)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per reply")
+    parser.add_argument("--loss", type=float, default=0.0, help="chance (0 - 1) of a request getting no reply")
+    parser.add_argument("--drop-when-busy", action="store_true",
+                        help="ignore requests and connections while the bulb is busy")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+# *************************************************************************
+# Load test for the API, against a fleet of simulated bulbs
+# Starts fake bulbs (see bulb_simulator.py), runs the app in process and
+#   fires requests at it at a set rate and concurrency, then reports the
+#   p50/p95/p99 latency of the requests and of the bulb commands, and how
+#   many commands were lost, dropped, failed or coalesced
+#
+# python3 tools/loadtest.py --bulbs 12 --rate 50 --concurrency 20 --duration 30
+# python3 tools/loadtest.py --mix set_colour=1,scene=1 --latency 0.05 --loss 0.01
+# *************************************************************************
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.bulb_simulator import new_bulb_configs, start_bulbs, write_snapshot
+
+DEFAULT_MIX = "set_colour=4,set_colour_async=2,set_power=2,scene=1"
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def summarise(latencies):
+    return {"count": len(latencies),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "max_ms": round(max(latencies) * 1000, 2) if latencies else None}
+
+
+# Records how long every bulb command takes, and how many fail, by wrapping the
+# connections' run method (this only works with the app running in process)
+
+class CommandRecorder:
+    def __init__(self):
+        self.latencies = []
+        self.failed = 0
+
+    def install(self, connection_service):
+        recorder = self
+        run = connection_service.BulbConnection.run
+
+        async def timed_run(connection, command, *args, **kwargs):
+            start = perf_counter()
+            result = await run(connection, command, *args, **kwargs)
+            recorder.latencies.append(perf_counter() - start)
+            if connection_service.command_failed(result):
+                recorder.failed += 1
+            return result
+
+        connection_service.BulbConnection.run = timed_run
+
+
+class LoadTest:
+    def __init__(self, client, bulb_names, mix, rate, concurrency, duration):
+        self.client = client
+        self.bulb_names = bulb_names
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.rate = rate
+        self.limit = asyncio.Semaphore(concurrency)
+        self.duration = duration
+        self.latencies = {}
+        self.errors = {}
+        self.skipped = 0  # requests not sent because every slot was busy
+        self.scene_running = False
+
+    def toggles(self):
+        names = random.sample(self.bulb_names, random.randint(1, len(self.bulb_names)))
+        return [{"name": name, "bright_mul": 1.0, "toggle": True} for name in names]
+
+    def request(self, operation):
+        if operation == "set_colour" or operation == "set_colour_async":
+            return "PUT", "/" + operation, {"red": random.randrange(256), "green": random.randrange(256),
+                                            "blue": random.randrange(256), "toggles": self.toggles()}
+        if operation == "set_power":
+            return "PUT", "/set_power", {"power": random.random() < 0.5, "toggles": self.toggles()}
+        if operation == "scene":
+            # alternately start a scene and stop it
+            self.scene_running = not self.scene_running
+            if self.scene_running:
+                return "POST", "/start_random_colour_scene_async", {"wait_time": 1, "toggles": self.toggles(),
+                                                                    "colour_list": [{"red": 255, "green": 0,
+                                                                                     "blue": 0},
+                                                                                    {"red": 0, "green": 0,
+                                                                                     "blue": 255}]}
+            return "POST", "/stop_scenes", None
+        raise ValueError("Unknown operation {}".format(operation))
+
+    async def fire(self, operation):
+        method, path, body = self.request(operation)
+        start = perf_counter()
+        try:
+            response = await self.client.request(method, path, json=body)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        finally:
+            self.limit.release()
+        name = "{} {}".format(method, path)
+        self.latencies.setdefault(name, []).append(perf_counter() - start)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def run(self):
+        # open loop: requests are started on schedule, whether or not earlier ones have finished
+        loop = asyncio.get_running_loop()
+        tasks = []
+        start = loop.time()
+        sent = 0
+        while loop.time() - start < self.duration:
+            sent += 1
+            await asyncio.sleep(max(0, start + sent / self.rate - loop.time()))
+            if self.limit.locked():
+                self.skipped += 1
+                continue
+            await self.limit.acquire()
+            operation = random.choices(self.operations, self.weights)[0]
+            tasks.append(asyncio.create_task(self.fire(operation)))
+        await asyncio.gather(*tasks)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        operation, weight = part.split('=')
+        mix[operation.strip()] = float(weight)
+    return mix
+
+
+async def run(args):
+    configs = new_bulb_configs(args.bulbs, args.versions.split(','))
+    fake_bulbs = await start_bulbs(configs, latency=args.latency, jitter=args.jitter, loss=args.loss,
+                                   drop_when_busy=args.drop_when_busy)
+    snapshot = os.path.join(tempfile.mkdtemp(), "snapshot.json")
+    write_snapshot(fake_bulbs, snapshot)
+    os.environ['TUYA_SNAPSHOT'] = snapshot
+
+    # the app reads the snapshot when it starts
+    from app.main import app, lifespan
+    from app.services import connection_service
+    from app.services.log_service import logs
+
+    recorder = CommandRecorder()
+    recorder.install(connection_service)
+
+    # --verbose logs every bulb command, otherwise only warnings get through
+    logs.set_level("DEBUG" if args.verbose else "WARNING")
+    try:
+        async with lifespan(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest",
+                                         timeout=args.request_timeout) as client:
+                load_test = LoadTest(client, [config['name'] for config in configs], parse_mix(args.mix),
+                                     args.rate, args.concurrency, args.duration)
+                await load_test.run()
+                await client.post("/stop_scenes")
+                queue_stats = connection_service.connections.queue_stats()
+    finally:
+        for fake_bulb in fake_bulbs:
+            await fake_bulb.stop()
+
+    bulb_stats = {key: sum(fake_bulb.stats[key] for fake_bulb in fake_bulbs)
+                  for key in ("received", "lost", "dropped", "refused", "replied")}
+    return {
+        "settings": vars(args),
+        "requests": {name: dict(summarise(latencies), errors=load_test.errors.get(name, 0))
+                     for name, latencies in sorted(load_test.latencies.items())},
+        "requests_skipped": load_test.skipped,
+        "bulb_commands": dict(summarise(recorder.latencies), failed=recorder.failed),
+        "bulbs": bulb_stats,
+        "coalesced": sum(stats["coalesced"] for stats in queue_stats.values()),
+        "unchanged": sum(stats["unchanged"] for stats in queue_stats.values()),
+    }
+
+
+def print_report(report):
+    print("{:<42} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7}".format("request", "count", "p50 ms", "p95 ms", "p99 ms",
+                                                              "max ms", "errors"))
+    rows = list(report["requests"].items()) + [("bulb commands", dict(report["bulb_commands"],
+                                                                      errors=report["bulb_commands"]["failed"]))]
+    for name, stats in rows:
+        print("{:<42} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7}".format(name, stats["count"], stats["p50_ms"],
+                                                                  stats["p95_ms"], stats["p99_ms"],
+                                                                  stats["max_ms"], stats["errors"]))
+    bulbs = report["bulbs"]
+    print()
+    print("Requests skipped (concurrency limit): {}".format(report["requests_skipped"]))
+    print("Bulb requests: {} received, {} lost, {} dropped while busy, {} connections refused"
+          .format(bulbs["received"], bulbs["lost"], bulbs["dropped"], bulbs["refused"]))
+    print("Commands coalesced: {}, skipped as unchanged: {}".format(report["coalesced"], report["unchanged"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the API, against simulated bulbs")
+    parser.add_argument("--bulbs", type=int, default=12)
+    parser.add_argument("--versions", default="3.3,3.4,3.5", help="protocol versions, given to the bulbs in turn")
+    parser.add_argument("--latency", type=float, default=0.03, help="seconds before each bulb reply")
+    parser.add_argument("--jitter", type=float, default=0.02, help="up to this many extra seconds per reply")
+    parser.add_argument("--loss", type=float, default=0.0, help="chance (0 - 1) of a bulb request getting no reply")
+    parser.add_argument("--drop-when-busy", action="store_true", help="bulbs ignore requests while busy")
+    parser.add_argument("--rate", type=float, default=20, help="requests started per second")
+    parser.add_argument("--concurrency", type=int, default=10, help="most requests in flight at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weights of set_colour, set_colour_async, set_power and scene (default: {})"
+                        .format(DEFAULT_MIX))
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the report as json to this file")
+    parser.add_argument("--verbose", action="store_true", help="log every bulb command the app sends")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+
+
+if __name__ == "__main__":
+    main()
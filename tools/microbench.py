@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+# *************************************************************************
+# Microbenchmarks for the hot paths that run inside the API
+# Covers the colour maths, matching toggles to bulbs, parsing the request
+#   models, compiling the scene timelines, and one tick of each scene (with
+#   the bulb I/O stubbed out)
+# Results are written as json, and can be compared against a baseline
+#
+# python3 tools/microbench.py --output results.json
+# python3 tools/microbench.py --compare tools/baselines/microbench.json
+# *************************************************************************
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.bulb_simulator import new_bulb_configs
+
+BENCH_BULBS = 12
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "microbench.json")
+DEFAULT_THRESHOLD = 0.25  # flag anything more than 25% slower than the baseline
+
+
+# The app loads its bulbs from a snapshot, so point it at a made up one (the bulbs are never
+# contacted). Half are 'Lights', so both default scene lists are used
+
+def load_app():
+    configs = new_bulb_configs(BENCH_BULBS, ["3.3"])
+    for i, config in enumerate(configs):
+        config["name"] = "Bench {} {}".format("Light" if i % 2 else "Lamp", i + 1)
+        config["ip"] = "127.0.0.1"
+    snapshot = os.path.join(tempfile.mkdtemp(), "snapshot.json")
+    with open(snapshot, 'w') as outfile:
+        json.dump({"devices": configs}, outfile)
+    os.environ['TUYA_SNAPSHOT'] = snapshot
+
+    global Colours, bulb_models, bulb_service, colour_service, connections, logs, scene_service, timeline_service
+    import Colours
+    from app.models import bulb as bulb_models
+    from app.services import bulb_service, colour_service, scene_service, timeline_service
+    from app.services.log_service import logs
+    bulb_models.load_bulbs()
+    from app.services.connection_service import connections
+
+    async def send(this_bulb, command, *args, **kwargs):
+        return {}
+
+    connections.send = send
+
+
+# Times fn over a number of runs, and returns the median and best time per call. Comparisons
+# use the best time, as it is the least affected by whatever else the machine is doing
+
+def measure(fn, number, runs):
+    timings = []
+    for run in range(runs):
+        start = perf_counter()
+        for i in range(number):
+            fn()
+        timings.append((perf_counter() - start) / number)
+    return {"ns_per_op": round(median(timings) * 1e9, 1), "best_ns_per_op": round(min(timings) * 1e9, 1),
+            "number": number, "runs": runs}
+
+
+# Scenes loop until stopped, so they get a clock that stops them after their first tick
+
+def scene_tick(scene, *args):
+    clock = scene_service.SceneClock()
+
+    async def one_tick(period):
+        clock.stop()
+        return False
+
+    clock.tick = one_tick
+
+    async def run():
+        token = scene_service.current_clock.set(clock)
+        try:
+            await scene(*args)
+        finally:
+            scene_service.current_clock.reset(token)
+
+    return run
+
+
+def benchmarks():
+    palette = Colours.ALL_COLOURS
+    rows = [(col['red'], col['green'], col['blue'], mul) for col in palette for mul in (0.2, 0.5, 1.0, 2.0, 4.0)]
+
+    def colours_cached():
+        for row in rows:
+            colour_service.get_final_colours(*row)
+
+    def colours_uncached():
+        colour_service.final_colours.cache_clear()
+        for row in rows:
+            colour_service.get_final_colours(*row)
+
+    def colours_batch():
+        colour_service.final_colours_batch(rows)
+
+    rgb_payload = {"red": 200, "green": 100, "blue": 50,
+                   "toggles": [toggle.model_dump() for toggle in bulb_models.bulb_toggles]}
+    multi_payload = {"wait_time": 5, "bulb_lists": [[toggle.model_dump() for toggle in bulb_list]
+                                                    for bulb_list in bulb_models.multi_scene_toggles],
+                     "colour_list": palette}
+    lightning_payload = {"lightning_percent_chance": 100, "lightning_length": 0, "wait_time_range": [0, 0.001],
+                         "toggles": [{"name": this_bulb.name} for this_bulb in bulb_models.bulbs[:4]]}
+    rgb = bulb_models.RgbClass.model_validate(rgb_payload)
+
+    def resolve_toggles():
+        bulb_models.registry.resolve(rgb.toggles)
+
+    def resolve_default_toggles():
+        bulb_models.registry.resolve(bulb_models.bulb_toggles)
+
+    multi_scene = bulb_models.MultiColourSceneClass.model_validate(multi_payload)
+    random_scene = bulb_models.RandomColourSceneClass.model_validate(
+        {"wait_time": 5, "toggles": rgb_payload["toggles"], "colour_list": palette})
+    lightning_scene = bulb_models.LightningSceneClass.model_validate(lightning_payload)
+
+    # the timelines are compiled once when a scene starts, so the ticks are timed on their own
+    xmas_timeline = timeline_service.compile_xmas(5)
+    multi_timeline = timeline_service.compile_multi_colour(multi_scene)
+    random_timeline = timeline_service.compile_random_colour(random_scene)
+    play = timeline_service.play
+
+    scenes = {
+        "scene_tick_xmas": scene_tick(play, xmas_timeline, False),
+        "scene_tick_multi_colour": scene_tick(play, multi_timeline, False),
+        "scene_tick_multi_colour_async": scene_tick(play, multi_timeline, True),
+        "scene_tick_random_colour": scene_tick(play, random_timeline, False),
+        "scene_tick_random_colour_async": scene_tick(play, random_timeline, True),
+        "scene_tick_lightning": scene_tick(bulb_service.lightning_scene_async, lightning_scene),
+    }
+
+    cases = {
+        "colours_scalar_cached": (colours_cached, 200),
+        "colours_scalar_uncached": (colours_uncached, 200),
+        "colours_batch": (colours_batch, 200),
+        "resolve_request_toggles": (resolve_toggles, 2000),
+        "resolve_default_toggles": (resolve_default_toggles, 2000),
+        "parse_rgb": (lambda: bulb_models.RgbClass.model_validate(rgb_payload), 2000),
+        "parse_multi_colour_scene": (lambda: bulb_models.MultiColourSceneClass.model_validate(multi_payload), 2000),
+        "parse_lightning_scene": (lambda: bulb_models.LightningSceneClass.model_validate(lightning_payload), 2000),
+        "scene_compile_xmas": (lambda: timeline_service.compile_xmas(5), 2000),
+        "scene_compile_multi_colour": (lambda: timeline_service.compile_multi_colour(multi_scene), 200),
+        "scene_compile_random_colour": (lambda: timeline_service.compile_random_colour(random_scene), 200),
+    }
+
+    loop = asyncio.new_event_loop()
+    for name, run in scenes.items():
+        cases[name] = ((lambda run=run: loop.run_until_complete(run())), 50)
+    return cases, loop
+
+
+def run_benchmarks(runs, only=None):
+    cases, loop = benchmarks()
+    # the scene_tick cases run a whole scene for one tick, so leave out the records logged when a
+    # scene starts and stops. Anything else logged is thrown away rather than written out
+    logs.set_level(logging.WARNING)
+    logs.start(logging.NullHandler())
+    try:
+        results = {name: measure(fn, number, runs) for name, (fn, number) in cases.items()
+                   if not only or any(part in name for part in only)}
+    finally:
+        logs.stop()
+        loop.close()
+    return {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(),
+                 "numpy": colour_service.np.__version__ if colour_service.np is not None else None,
+                 "bulbs": BENCH_BULBS, "runs": runs},
+        "results": results,
+    }
+
+
+# Returns the benchmarks that are slower than the baseline by more than the threshold
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print("{:<34} {:>14} {:>14} {:>8}".format("benchmark", "baseline ns", "current ns", "ratio"))
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print("{:<34} {:>14} {:>14.1f} {:>8}".format(name, "-", result["best_ns_per_op"], "new"))
+            continue
+        ratio = result["best_ns_per_op"] / base["best_ns_per_op"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<34} {:>14.1f} {:>14.1f} {:>8.2f}{}".format(name, base["best_ns_per_op"], result["best_ns_per_op"],
+                                                             ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the API hot paths")
+    parser.add_argument("--runs", type=int, default=7, help="timed runs of each benchmark (the median is kept)")
+    parser.add_argument("--only", nargs="*", help="only run benchmarks with these words in their names")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE,
+                        help="compare against a baseline (default: {})".format(DEFAULT_BASELINE))
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="how much slower (0.25 = 25%%) counts as a regression")
+    args = parser.parse_args()
+
+    load_app()
+    results = run_benchmarks(args.runs, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()